@@ -0,0 +1,204 @@
+"""
+Offline benchmark of Summarizer.get_youtube_summary and Chat.free_chat.
+
+The LLM backend is a local OpenAI compatible stub and transcripts come from a
+fake provider, so nothing leaves the machine. Transcripts are synthetic
+auto generated captions of several lengths, or recorded ones loaded with
+--transcripts from *.json files holding the caption list returned by
+YouTubeTranscriptApi.
+
+    python benchmarks/bench.py --requests 20 --concurrency 5 --latency 0.5
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Awaitable, Callable, Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+os.environ.setdefault('OPENAI_API_KEY', 'stub')
+
+from chat import Chat
+from llm_scheduler import LLMScheduler
+from openai_stub import StubState, start_stub
+from summarizer import Summarizer
+
+logger = logging.getLogger('bench')
+
+# Synthetic transcripts, name to length in seconds
+SIZES = {'10min': 600, '1h': 3600, '3h': 10800}
+VOCABULARY = ("so today we are going to talk about how the model works and why "
+              "training data matters for the final quality of results you know").split()
+
+
+def synthetic_captions(seconds: int, seed: int=0) -> List[dict]:
+    """Captions in the style of YouTube auto generated ones, each cue repeats the tail of the previous"""
+    rnd = random.Random(seed)
+    captions = []
+    previous = []
+    start = 0.0
+    while start < seconds:
+        words = previous[-3:] + [rnd.choice(VOCABULARY) for _ in range(rnd.randint(5, 9))]
+        duration = rnd.uniform(2.0, 4.0)
+        captions.append({'text': " ".join(words), 'start': round(start, 3), 'duration': round(duration, 3)})
+        previous = words
+        # Now and then leave a pause in speech
+        start += duration + (rnd.uniform(1.0, 3.0) if rnd.random() < 0.05 else 0.0)
+    return captions
+
+def load_transcripts(path: str=None) -> Dict[str, List[dict]]:
+    if not path:
+        return {name: synthetic_captions(seconds, seed=i) for i, (name, seconds) in enumerate(SIZES.items())}
+    transcripts = {}
+    for file_name in sorted(glob.glob(os.path.join(path, '*.json'))):
+        name = os.path.splitext(os.path.basename(file_name))[0].replace('_', '-')
+        with open(file_name, 'r') as f:
+            transcripts[name] = json.load(f)
+    return transcripts
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class FakeTranscriptFetcher:
+    """Stands in for TranscriptFetcher, video ids look like <transcript name>_<n>"""
+    def __init__(self, transcripts: Dict[str, List[dict]], latency: float=0.0) -> None:
+        self.transcripts = transcripts
+        self.latency = latency
+
+    def fetch(self, video_id: str, languages: List[str]):
+        time.sleep(self.latency)
+        return 'en', self.transcripts[video_id.rsplit('_', 1)[0]]
+
+
+class TiktokenTimer:
+    """Proxy around a tiktoken encoding that sums the time spent inside its calls"""
+    def __init__(self, encoding) -> None:
+        self.encoding = encoding
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.encoding, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.seconds += time.perf_counter() - started
+        return timed
+
+
+async def run_scenario(name: str, calls: List[Callable[[], Awaitable]], concurrency: int, timer: TiktokenTimer, stub: StubState) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(call: Callable[[], Awaitable]) -> None:
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await call()
+            except Exception as e:
+                errors += 1
+                logger.warning(f"{name}: {type(e).__name__} {e}")
+            latencies.append(time.perf_counter() - started)
+
+    tiktoken_before = timer.seconds
+    prompt_before, generated_before = stub.prompt_tokens, stub.generated_tokens
+    tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(call) for call in calls))
+    wall = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tokens = (stub.prompt_tokens - prompt_before) + (stub.generated_tokens - generated_before)
+    return {
+        'scenario': name,
+        'requests': len(calls),
+        'errors': errors,
+        'p50_s': percentile(latencies, 50),
+        'p95_s': percentile(latencies, 95),
+        'throughput_rps': len(calls) / wall,
+        'tokens_per_s': tokens / wall,
+        'tiktoken_s': timer.seconds - tiktoken_before,
+        'peak_mb': peak / 1024 / 1024,
+    }
+
+def print_report(results: List[dict]) -> None:
+    header = f"{'scenario':<16}{'req':>5}{'err':>5}{'p50 s':>9}{'p95 s':>9}{'req/s':>9}{'tok/s':>11}{'tiktoken s':>12}{'peak MB':>10}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['scenario']:<16}{r['requests']:>5}{r['errors']:>5}{r['p50_s']:>9.2f}{r['p95_s']:>9.2f}"
+              f"{r['throughput_rps']:>9.2f}{r['tokens_per_s']:>11.0f}{r['tiktoken_s']:>12.3f}{r['peak_mb']:>10.1f}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20, help="Requests per scenario.")
+    parser.add_argument('--concurrency', type=int, default=5, help="Requests in flight at once.")
+    parser.add_argument('--latency', type=float, default=0.5, help="Stub seconds before the first token.")
+    parser.add_argument('--tokens-per-second', type=float, default=200.0, help="Stub generation throughput.")
+    parser.add_argument('--completion-tokens', type=int, default=200, help="Tokens in every stub answer.")
+    parser.add_argument('--transcript-latency', type=float, default=0.0, help="Seconds the fake transcript fetch takes.")
+    parser.add_argument('--transcripts', type=str, default=None, help="Directory with recorded transcripts as *.json.")
+    parser.add_argument('--rpm', type=int, default=None, help="Put an LLMScheduler with this requests per minute in front of the stub.")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON lines.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    stub = StubState(args.latency, args.tokens_per_second, args.completion_tokens)
+    server = start_stub(stub)
+    base_url = f"http://{server.server_address[0]}:{server.server_address[1]}/v1"
+    scheduler = LLMScheduler(requests_per_minute=args.rpm) if args.rpm else None
+
+    summarizer = Summarizer(base_url=base_url, scheduler=scheduler)
+    summarizer.transcript_fetcher = FakeTranscriptFetcher(load_transcripts(args.transcripts), args.transcript_latency)
+    summarizer.tokenizer = TiktokenTimer(summarizer.tokenizer)
+    free_chat = Chat(base_url=base_url, scheduler=scheduler)
+    free_chat.tokenizer = TiktokenTimer(free_chat.tokenizer)
+
+    results = []
+    for name in summarizer.transcript_fetcher.transcripts:
+        # Distinct videos and chats so neither caches nor coalescing hide the work
+        calls = [
+            lambda i=i: summarizer.get_youtube_summary(chat_id=i, text=f"https://youtu.be/{name}_{i}")
+            for i in range(args.requests)
+        ]
+        results.append(await run_scenario(f"summary {name}", calls, args.concurrency, summarizer.tokenizer, stub))
+
+    threads = max(1, args.concurrency)
+    calls = [
+        lambda i=i: free_chat.free_chat(
+            f"Question number {i}: " + " ".join(VOCABULARY),
+            chat_id=i % threads, user_id=1, message_id=i, reply_id=i - threads if i >= threads else None,
+        )
+        for i in range(args.requests)
+    ]
+    results.append(await run_scenario("free_chat", calls, args.concurrency, free_chat.tokenizer, stub))
+
+    server.shutdown()
+    if args.json:
+        for r in results:
+            print(json.dumps(r))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
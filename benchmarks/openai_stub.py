@@ -0,0 +1,95 @@
+"""
+Local OpenAI compatible stand-in for benchmarks.
+
+It answers POST /chat/completions after a configurable delay that models the
+time to first token plus generation at a fixed token throughput.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('bench.openai_stub')
+
+WORDS = "the main point of this part is that the speaker explains how it works and why it matters".split()
+
+
+class StubState:
+    """Settings and counters shared by all request handlers"""
+    def __init__(self, latency: float=0.5, tokens_per_second: float=50.0, completion_tokens: int=200) -> None:
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+
+    def count(self, prompt_tokens: int, completion_tokens: int) -> None:
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += prompt_tokens
+            self.generated_tokens += completion_tokens
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args) -> None:
+            logger.debug(format % args)
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not self.path.endswith('/chat/completions'):
+                self.send_error(404)
+                return
+            # Rough count, the stub only needs to be consistent between runs
+            prompt_tokens = sum(len(message.get('content') or '') // 4 for message in request.get('messages', []))
+            completion_tokens = state.completion_tokens
+            time.sleep(state.latency + completion_tokens / state.tokens_per_second)
+            state.count(prompt_tokens, completion_tokens)
+
+            content = " ".join(WORDS[i % len(WORDS)] for i in range(completion_tokens))
+            body = json.dumps({
+                'id': f"chatcmpl-stub-{state.requests}",
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request.get('model', 'stub'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens},
+            }).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def start_stub(state: StubState, host: str='127.0.0.1', port: int=0) -> ThreadingHTTPServer:
+    """Start the stub in a background thread, port 0 picks a free one"""
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"OpenAI stub listening on {server.server_address}")
+    return server
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.5, help="Seconds before the first token.")
+    parser.add_argument('--tokens-per-second', type=float, default=50.0, help="Generation throughput.")
+    parser.add_argument('--completion-tokens', type=int, default=200, help="Tokens in every answer.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    server = start_stub(StubState(args.latency, args.tokens_per_second, args.completion_tokens), port=args.port)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,95 @@
+"""
+Fake Telegram sender for the webhook mode.
+
+Posts synthetic message updates the way the Bot API does, over a few keep
+alive connections with the secret token header, to the webhook of a running
+bot and reports how fast they are acknowledged. A request with a wrong secret
+is sent first and must be rejected.
+
+    python benchmarks/webhook_sender.py --url http://127.0.0.1:8443/telegram --secret <webhook_secret> --updates 1000 --connections 40
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import List, Tuple
+from urllib.parse import urlsplit
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def fake_update(update_id: int, chat_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group', 'title': 'bench'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+            'text': f"message {update_id}",
+        },
+    }
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+async def post(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, path: str, secret: str, body: bytes) -> int:
+    writer.write((f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                  f"Content-Length: {len(body)}\r\n{SECRET_HEADER}: {secret}\r\n\r\n").encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+async def connection(url: str, secret: str, updates: List[dict]) -> Tuple[List[float], int]:
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    latencies, failed = [], 0
+    for update in updates:
+        started = time.perf_counter()
+        status = await post(reader, writer, parts.netloc, parts.path, secret, json.dumps(update).encode())
+        latencies.append(time.perf_counter() - started)
+        failed += status != 200
+    writer.close()
+    return latencies, failed
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', required=True, type=str, help="Webhook of a running bot.")
+    parser.add_argument('--secret', required=True, type=str, help="Secret token the webhook expects.")
+    parser.add_argument('--updates', type=int, default=1000, help="Updates to send.")
+    parser.add_argument('--connections', type=int, default=40, help="Parallel keep alive connections, Telegram uses up to 100.")
+    parser.add_argument('--chats', type=int, default=50, help="Distinct chats the updates come from.")
+    args = parser.parse_args()
+
+    url = args.url
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    rejected = await post(reader, writer, parts.netloc, parts.path, args.secret + 'x', json.dumps(fake_update(0, 1)).encode())
+    writer.close()
+    print(f"wrong secret -> {rejected}")
+
+    updates = [fake_update(i, 1 + i % args.chats) for i in range(1, args.updates + 1)]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(connection(url, args.secret, updates[i::args.connections]) for i in range(args.connections)))
+    wall = time.perf_counter() - started
+    latencies = [latency for connection_latencies, _ in results for latency in connection_latencies]
+    failed = sum(failed for _, failed in results)
+
+    print(f"updates {len(latencies)}  failed {failed}  {len(latencies) / wall:.0f} updates/s"
+          f"  ack p50 {percentile(latencies, 50) * 1000:.2f} ms  p95 {percentile(latencies, 95) * 1000:.2f} ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
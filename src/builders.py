@@ -0,0 +1,97 @@
+from datetime import datetime
+import logging
+import os
+from typing import Optional
+
+from job_queue import JobQueue
+from llm_scheduler import LLMScheduler
+from seen_registry import SeenRegistry
+from summarizer import Summarizer
+from summary_cache import SummaryCache
+from transcript_cache import TranscriptCache
+
+logger = logging.getLogger('bot')
+
+
+def setup_logger(log_level: Optional[str]='INFO', logfile: Optional[str]=None) -> None:
+    """Logger setup to write into console and to the file (Optional)"""
+    log_formatter = logging.Formatter('%(asctime)s %(name)s [%(levelname)s] %(message)s', datefmt='%d-%m-%Y %H:%M:%S')
+    logger.setLevel(log_level)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(log_level)
+    console_handler.setFormatter(log_formatter)
+    logger.addHandler(console_handler)
+
+    if logfile:
+        fileHandler = logging.FileHandler("{0}_{1}".format(logfile, datetime.utcnow().strftime('%F_%T.%f')[:-3]))
+        fileHandler.setLevel(log_level)
+        fileHandler.setFormatter(log_formatter)
+        logger.addHandler(fileHandler)
+
+
+def build_scheduler(config: dict) -> LLMScheduler:
+    return LLMScheduler(
+        requests_per_minute=config.get('llm_requests_per_minute', 500),
+        tokens_per_minute=config.get('llm_tokens_per_minute', 1000000),
+        completion_tokens=config.get('llm_completion_tokens', 1000),
+        bulk_every=config.get('llm_bulk_every', 4),
+    )
+
+
+def build_summarizer(config: dict, scheduler: LLMScheduler) -> Summarizer:
+    """Summarizer with the caches configured in config.yml, shared by the bot and the worker processes"""
+    proxies = config.get('youtube_api_proxies', None)
+    if not proxies:
+        proxies = {}
+        if os.environ.get('HTTP_PROXY', None):
+            proxies['http'] = os.environ['HTTP_PROXY']
+        if os.environ.get('HTTPS_PROXY', None):
+            proxies['https'] = os.environ['HTTPS_PROXY']
+
+    transcript_cache = TranscriptCache(
+        path=config.get('transcript_cache_dir', 'cache/transcripts'),
+        max_bytes=config.get('transcript_cache_max_bytes', 256 * 1024 * 1024),
+        ttl=config.get('transcript_cache_ttl', 7 * 24 * 3600),
+    )
+
+    summary_cache = SummaryCache(
+        max_entries=config.get('summary_cache_max_entries', 500),
+        path=config.get('summary_cache_path', None),
+    )
+
+    seen = SeenRegistry(
+        ttl=config.get('seen_ttl', 30 * 24 * 3600),
+        max_per_chat=config.get('seen_max_per_chat', 1000),
+        path=config.get('seen_path', 'cache/seen.sqlite'),
+    )
+
+    return Summarizer(
+        base_url=config.get('base_url', "https://api.deepseek.com"),
+        youtube_api_proxies=proxies,
+        max_concurrent_chunks=config.get('max_concurrent_chunks', 4),
+        chunk_retries=config.get('chunk_retries', 2),
+        transcript_cache=transcript_cache,
+        summary_cache=summary_cache,
+        chunk_overlap=config.get('chunk_overlap', 1),
+        align_to_pauses=config.get('align_to_pauses', True),
+        compact_transcript=config.get('compact_transcript', True),
+        max_cost=config.get('max_cost', 10),
+        max_reduce_depth=config.get('max_reduce_depth', 3),
+        reduce_token_budget=config.get('reduce_token_budget', 200000),
+        clarify_top_k=config.get('clarify_top_k', 4),
+        clarify_window_tokens=config.get('clarify_window_tokens', 1000),
+        seen=seen,
+        scheduler=scheduler,
+        prefetch_concurrency=config.get('prefetch_concurrency', 2),
+        prefetch_max_bytes=config.get('prefetch_max_bytes', 64 * 1024 * 1024) if config.get('prefetch_transcripts', False) else 0,
+        # Workers summarize queued requests, the bot can only warm the transcript cache for them
+        prefetch_tokenize=not config.get('job_queue_path', None),
+    )
+
+
+def build_job_queue(config: dict) -> JobQueue:
+    return JobQueue(
+        config['job_queue_path'],
+        visibility_timeout=config.get('job_visibility_timeout', 900),
+        max_attempts=config.get('job_max_attempts', 3),
+    )
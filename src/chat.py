@@ -1,71 +1,146 @@
-from collections import defaultdict
 import logging
 import os
+import time
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 import tiktoken
 
+from completion import complete, Progress
+from conversation_store import ConversationStore, Node
 from exceptions import *
+from llm_scheduler import INTERACTIVE, LLMScheduler
+from metrics import stage, TOKENS
 
 logger = logging.getLogger('bot.chat')
 
+COMPACT_PROMPT = """Summarize the conversation below so that it can be continued without it.
+Keep facts, names, numbers, code, decisions and open questions, drop greetings and repetitions.
+Write the summary in the language of the conversation."""
+
 
 class Chat:
     """Main free chat logic"""
-    def __init__(self, chat_model: str='deepseek-chat', base_url: str='https://api.deepseek.com', model_token_limit: int=64000) -> None:
+    def __init__(self, chat_model: str='deepseek-chat', base_url: str='https://api.deepseek.com', model_token_limit: int=64000, scheduler: LLMScheduler=None, store: ConversationStore=None, compact_at: int=40000, keep_recent_tokens: int=8000) -> None:
         """Construct a :class:`Summarizer <Summarizer>`.
 
         :param chat_model:
             Type of the backend model to use
         :param model_token_limit:
             Max token limit that backend model supports
+        :param scheduler:
+            (Optional) Rate limiter shared with the summarizer, free chat goes to its interactive lane
+        :param store:
+            (Optional) Where reply chains and system prompts are kept, an in-memory store with default budgets by default
+        :param compact_at:
+            Thread length in tokens at which older turns are summarized, 0 disables compaction
+        :param keep_recent_tokens:
+            Tokens of the latest turns that are always sent as they are
         """
         self.base_url = base_url
         self.chat_model = chat_model
         api_key = os.environ.get('OPENAI_API_KEY', None)
         if not api_key:
             raise Exception("API key is not set in the environment variable OPENAI_API_KEY") 
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url)
         self.max_tokens = 50000
         self.model_token_limit = model_token_limit
         self.tokenizer = tiktoken.encoding_for_model('gpt-4o')
-        self.conversation = defaultdict(dict)
-        self.system_prompt = defaultdict(dict)
+        self.store = store or ConversationStore()
+        self.scheduler = scheduler
+        self.compact_at = compact_at
+        self.keep_recent_tokens = keep_recent_tokens
     
     def set_system_prompt(self, chat_id: str, user_id: str, prompt: str) -> None:
-        self.system_prompt[chat_id][user_id] = prompt
+        self.store.set_system_prompt(chat_id, user_id, prompt, self.count_tokens(prompt))
+
+    def count_tokens(self, text: str) -> int:
+        with stage('chat_tokenize'):
+            tokens = len(self.tokenizer.encode(text))
+        TOKENS.labels('chat').inc(tokens)
+        return tokens
+
+    def add_message(self, chat_id: str, message_id: int, request: dict, reply_id: int=None) -> Node:
+        """
+        Store a message of the conversation
+        Its own token count is computed once, the total covers the whole reply chain up to it
+        """
+        tokens = self.count_tokens(request["content"])
+        parent = self.store.get(chat_id, reply_id)
+        node = Node(request["role"], request["content"], reply_id, tokens, tokens + (parent.total if parent else 0), time.time())
+        self.store.add(chat_id, message_id, node)
+        return node
+
+    async def summarize_turns(self, chat_id: str, requests: list, tokens: int) -> str:
+        transcript = "\n\n".join(f"{r['role']}: {r['content']}" for r in requests)
+        if self.scheduler:
+            await self.scheduler.acquire(INTERACTIVE, chat_id, tokens)
+        with stage('chat_compact'):
+            _, summary = await complete(self.client, self.chat_model, [
+                {"role": "system", "content": COMPACT_PROMPT},
+                {"role": "user", "content": transcript}
+            ])
+        return summary
+
+    async def compact(self, chat_id: str, message_id: int, node: Node, limit: int) -> int:
+        """
+        Summarize the older turns of the thread once it is longer than limit
+        The summary is kept on the newest summarized message, later requests of the thread start from it
+        Return the length of the thread after compaction
+        """
+        chain = self.store.chain(chat_id, node.reply_id)
+        recent = node.tokens
+        cut = 0
+        while cut < len(chain) and not chain[cut][1].summary and recent + chain[cut][1].tokens <= self.keep_recent_tokens:
+            recent += chain[cut][1].tokens
+            cut += 1
+        older = chain[cut:]
+        older_tokens = sum(parent.summary_tokens if parent.summary else parent.tokens for _, parent in older)
+        if recent + older_tokens > limit and (len(older) > 1 or older and not older[0][1].summary):
+            requests = [parent.request() for _, parent in reversed(older)]
+            summary = await self.summarize_turns(chat_id, requests, older_tokens)
+            logger.info(f"Compacted {len(older)} messages of {older_tokens} tokens")
+            older[0][1].summary = summary
+            older[0][1].summary_tokens = older_tokens = self.count_tokens(summary)
+
+        # Cached totals may also predate a compaction made on another branch of the thread
+        total = older_tokens
+        if older:
+            older[0][1].total = total
+            self.store.add(chat_id, *older[0])
+        for parent_id, parent in reversed(chain[:cut]):
+            total += parent.tokens
+            parent.total = total
+            self.store.add(chat_id, parent_id, parent)
+        node.total = total + node.tokens
+        self.store.add(chat_id, message_id, node)
+        return node.total
     
-    def free_chat(self, message: str, chat_id:str, user_id:str, message_id: int, reply_id: int=None) -> str:
+    async def free_chat(self, message: str, chat_id:str, user_id:str, message_id: int, reply_id: int=None, on_progress: Progress=None) -> str:
         """
         Calculate the length of the conversation in number of tokens
+        Compact older turns when the thread grows too long
         Process all messages if the request fits the model
+        Stream the answer to on_progress when given
         """
         request = {"role": "user", "content": message}
-        conversation = self.conversation[chat_id]
-        conversation[message_id] = {"request": request, "reply_id": reply_id}
-        
-        requests = [request]
-        while reply_id in conversation:
-            requests.append(conversation[reply_id]["request"])
-            reply_id = conversation[reply_id]["reply_id"]
-
-        system_prompt = ""
-        if chat_id in self.system_prompt:
-            system_prompt = self.system_prompt[chat_id].get(user_id, "")
+        node = self.add_message(chat_id, message_id, request, reply_id)
+        system_prompt, system_prompt_tokens = self.store.get_system_prompt(chat_id, user_id)
+        tokens = node.total + system_prompt_tokens
+        if self.compact_at and tokens > self.compact_at:
+            tokens = await self.compact(chat_id, message_id, node, self.compact_at - system_prompt_tokens) + system_prompt_tokens
         
-        if system_prompt:
-            requests.append({"role": "system", "content": system_prompt})
+        # Oldest first with the system prompt in front, the provider caches the common prefix of the thread
+        requests = [{"role": "system", "content": system_prompt}] if system_prompt else []
+        requests.extend(parent.request() for _, parent in reversed(self.store.chain(chat_id, reply_id)))
+        requests.append(request)
 
-        concatenated_messages = " ".join(r["content"] for r in requests)
-        tokens = self.tokenizer.encode(concatenated_messages)
-        logger.info(f"The length is {len(tokens)}")
-        if len(tokens) > self.max_tokens:
-            raise TooLongMessageException(len(tokens))
+        logger.info(f"The length is {tokens}")
+        if tokens > self.max_tokens:
+            raise TooLongMessageException(tokens)
 
-        requests.reverse()
+        if self.scheduler:
+            await self.scheduler.acquire(INTERACTIVE, chat_id, tokens)
         
-        response = self.client.chat.completions.create(
-            model=self.chat_model,
-            messages=requests
-        )
-        return {"role": response.choices[0].message.role, "content": response.choices[0].message.content.strip()}
\ No newline at end of file
+        with stage('free_chat'):
+            role, content = await complete(self.client, self.chat_model, requests, on_progress)
+        return {"role": role, "content": content}
\ No newline at end of file
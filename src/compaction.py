@@ -0,0 +1,65 @@
+import re
+from typing import List, Tuple
+
+# Words that carry no meaning in spoken transcripts
+FILLERS = {
+    'ru': {'э', 'ээ', 'эээ', 'эм', 'эмм', 'мм', 'ммм', 'хм', 'угу'},
+    'en': {'um', 'umm', 'uh', 'uhh', 'uhm', 'erm', 'er', 'hmm', 'mm', 'mhm'},
+}
+# Sound annotations of auto generated captions like [Music] or [Музыка]
+ANNOTATION = re.compile(r'\[[^\]]*\]')
+PUNCTUATION = ',.!?…-'
+# Rolling captions repeat at most this many words of the previous cue
+MAX_ROLLING_OVERLAP = 30
+
+
+def format_timestamp(seconds: float) -> str:
+    """Short [mm:ss] or [h:mm:ss] marker"""
+    hours, remainder = divmod(int(seconds), 3600)
+    mins, secs = divmod(remainder, 60)
+    if hours:
+        return f"[{hours}:{mins:02d}:{secs:02d}]"
+    return f"[{mins:02d}:{secs:02d}]"
+
+def clean_words(text: str, language: str) -> List[str]:
+    """Split caption text into words without annotations and filler words"""
+    fillers = FILLERS.get(language, set())
+    words = ANNOTATION.sub(' ', text).split()
+    return [word for word in words if word.lower().strip(PUNCTUATION) not in fillers]
+
+def drop_rolling_overlap(previous: List[str], words: List[str]) -> List[str]:
+    """Remove the beginning of a cue that repeats the end of the previous one"""
+    longest = min(len(previous), len(words), MAX_ROLLING_OVERLAP)
+    for size in range(longest, 0, -1):
+        if previous[-size:] == words[:size]:
+            return words[size:]
+    return words
+
+def compact_captions(captions: List[dict], language: str, group_seconds: float=30.0, pause_seconds: float=2.0) -> Tuple[List[str], List[float]]:
+    """
+    Merge captions into groups of up to group_seconds, each on one line behind a single timestamp
+    Start a new group after a pause of pause_seconds
+    Drop duplicated rolling caption text and filler words
+    Return the lines and the silence before each of them
+    """
+    segments, pauses = [], []
+    group_words, group_start, group_pause = [], 0.0, 0.0
+    previous_words, previous_end = [], 0.0
+    for line in captions:
+        cleaned = clean_words(line["text"], language)
+        words = drop_rolling_overlap(previous_words, cleaned)
+        pause = max(0.0, line["start"] - previous_end)
+        previous_words, previous_end = cleaned, line["start"] + line["duration"]
+        if not words:
+            continue
+        if group_words and (line["start"] - group_start >= group_seconds or pause >= pause_seconds):
+            segments.append(f"{format_timestamp(group_start)} {' '.join(group_words)}\n")
+            pauses.append(group_pause)
+            group_words = []
+        if not group_words:
+            group_start, group_pause = line["start"], pause
+        group_words.extend(words)
+    if group_words:
+        segments.append(f"{format_timestamp(group_start)} {' '.join(group_words)}\n")
+        pauses.append(group_pause)
+    return segments, pauses
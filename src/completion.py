@@ -0,0 +1,48 @@
+import logging
+from typing import Awaitable, Callable, List, Tuple
+
+from openai import AsyncOpenAI
+
+from metrics import record_usage
+
+logger = logging.getLogger('bot.completion')
+
+# Returns the text generated so far, joined only when someone looks at it
+Render = Callable[[], str]
+# Told about new output, pulls the text with the render callable when it wants to show it
+Progress = Callable[[Render], Awaitable[None]]
+
+
+async def complete(client: AsyncOpenAI, model: str, messages: List[dict], on_delta: Progress=None) -> Tuple[str, str]:
+    """
+    Request a chat completion and return the role and the stripped content
+    Stream it when on_delta is given, on_delta is called on every token with a render of the text so far
+    """
+    if on_delta is None:
+        completion = await client.chat.completions.create(model=model, messages=messages)
+        record_usage(completion.usage)
+        message = completion.choices[0].message
+        return message.role, message.content.strip()
+
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True}
+    )
+    role, parts = "assistant", []
+
+    def render() -> str:
+        return "".join(parts)
+
+    async for event in stream:
+        if event.usage:
+            record_usage(event.usage)
+        if not event.choices:
+            continue
+        delta = event.choices[0].delta
+        role = delta.role or role
+        if delta.content:
+            parts.append(delta.content)
+            await on_delta(render)
+    return role, "".join(parts).strip()
@@ -0,0 +1,168 @@
+from collections import OrderedDict
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from sqlite_writer import connect, WriteBehind
+
+logger = logging.getLogger('bot.conversation_store')
+
+# Expired threads are looked for at most this often
+SWEEP_INTERVAL = 60
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+class Node:
+    """Message of a reply chain"""
+    __slots__ = ('role', 'content', 'reply_id', 'tokens', 'total', 'used_at', 'summary', 'summary_tokens')
+
+    def __init__(self, role: str, content: str, reply_id: Optional[int], tokens: int, total: int, used_at: float, summary: str=None, summary_tokens: int=0) -> None:
+        self.role = role
+        self.content = content
+        self.reply_id = reply_id
+        self.tokens = tokens
+        # Tokens of the whole chain up to and including this message
+        self.total = total
+        self.used_at = used_at
+        # Compacted thread up to and including this message, it replaces all of them in requests
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+
+    def request(self) -> dict:
+        if self.summary:
+            return {"role": "system", "content": SUMMARY_PREFIX + self.summary}
+        return {"role": self.role, "content": self.content}
+
+
+class ConversationStore:
+    """Free chat messages and system prompts, bounded by node budgets and TTL, optionally backed by SQLite"""
+    def __init__(self, max_nodes: int=100000, max_nodes_per_chat: int=5000, ttl: int=7 * 24 * 3600, path: str=None) -> None:
+        """Construct a :class:`ConversationStore <ConversationStore>`.
+
+        :param max_nodes:
+            Messages kept in memory over all chats, the least recently active chats lose their oldest messages first
+        :param max_nodes_per_chat:
+            Messages kept in memory per chat, the least recently used ones are evicted first
+        :param ttl:
+            Seconds a message is kept after it was last part of a conversation
+        :param path:
+            (Optional) SQLite file to keep threads across restarts, evicted messages are loaded back from it on demand
+        """
+        self.max_nodes = max_nodes
+        self.max_nodes_per_chat = max_nodes_per_chat
+        self.ttl = ttl
+        # Chats in the order of their last activity, messages in the order of their last use
+        self.chats: Dict[int, OrderedDict] = OrderedDict()
+        self.size = 0
+        self.system_prompts: Dict[tuple, tuple] = {}
+        self.swept = time.time()
+        self.db = None
+        self.writer = None
+        if path:
+            self.db = connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS messages (chat_id INTEGER, message_id INTEGER, role TEXT, content TEXT, reply_id INTEGER, tokens INTEGER, total INTEGER, used_at REAL, summary TEXT, summary_tokens INTEGER, PRIMARY KEY (chat_id, message_id))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS system_prompts (chat_id INTEGER, user_id INTEGER, prompt TEXT, tokens INTEGER, PRIMARY KEY (chat_id, user_id))")
+            self.db.execute("DELETE FROM messages WHERE used_at < ?", (time.time() - ttl,))
+            self.db.commit()
+            for chat_id, user_id, prompt, tokens in self.db.execute("SELECT chat_id, user_id, prompt, tokens FROM system_prompts"):
+                self.system_prompts[chat_id, user_id] = (prompt, tokens)
+            logger.info(f"Loaded system prompts for {len(self.system_prompts)} users")
+            # Evicted messages are read back through db, writes are committed off the event loop
+            self.writer = WriteBehind(path)
+
+    def set_system_prompt(self, chat_id: int, user_id: int, prompt: str, tokens: int) -> None:
+        self.system_prompts[chat_id, user_id] = (prompt, tokens)
+        if self.writer:
+            self.writer.execute("INSERT OR REPLACE INTO system_prompts (chat_id, user_id, prompt, tokens) VALUES (?, ?, ?, ?)", (chat_id, user_id, prompt, tokens))
+
+    def get_system_prompt(self, chat_id: int, user_id: int) -> tuple:
+        """System prompt of the user in the chat and its token count"""
+        return self.system_prompts.get((chat_id, user_id), ("", 0))
+
+    def _remember(self, chat_id: int, message_id: int, node: Node) -> None:
+        nodes = self.chats.get(chat_id)
+        if nodes is None:
+            nodes = self.chats[chat_id] = OrderedDict()
+        if message_id not in nodes:
+            self.size += 1
+        nodes[message_id] = node
+        nodes.move_to_end(message_id)
+        self.chats.move_to_end(chat_id)
+        while len(nodes) > self.max_nodes_per_chat:
+            nodes.popitem(last=False)
+            self.size -= 1
+        while self.size > self.max_nodes:
+            oldest_chat, oldest = next(iter(self.chats.items()))
+            oldest.popitem(last=False)
+            self.size -= 1
+            if not oldest:
+                del self.chats[oldest_chat]
+
+    def _forget(self, chat_id: int, message_id: int) -> None:
+        nodes = self.chats.get(chat_id)
+        if nodes and nodes.pop(message_id, None) is not None:
+            self.size -= 1
+            if not nodes:
+                del self.chats[chat_id]
+
+    def expire(self, now: float=None) -> None:
+        """Drop messages that were not used within TTL"""
+        now = now or time.time()
+        deadline = now - self.ttl
+        for chat_id, nodes in list(self.chats.items()):
+            while nodes and next(iter(nodes.values())).used_at < deadline:
+                nodes.popitem(last=False)
+                self.size -= 1
+            if not nodes:
+                del self.chats[chat_id]
+        if self.writer:
+            self.writer.execute("DELETE FROM messages WHERE used_at < ?", (deadline,))
+        self.swept = now
+
+    def add(self, chat_id: int, message_id: int, node: Node) -> None:
+        if node.used_at - self.swept > SWEEP_INTERVAL:
+            self.expire(node.used_at)
+        self._remember(chat_id, message_id, node)
+        if self.writer:
+            self.writer.execute("INSERT OR REPLACE INTO messages (chat_id, message_id, role, content, reply_id, tokens, total, used_at, summary, summary_tokens) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (chat_id, message_id, node.role, node.content, node.reply_id, node.tokens, node.total, node.used_at, node.summary, node.summary_tokens))
+
+    def get(self, chat_id: int, message_id: Optional[int]) -> Optional[Node]:
+        """Message from memory or, once evicted, from SQLite, None when it is unknown or expired"""
+        if message_id is None:
+            return None
+        nodes = self.chats.get(chat_id)
+        node = nodes.get(message_id) if nodes else None
+        if node is None and self.db:
+            row = self.db.execute("SELECT role, content, reply_id, tokens, total, used_at, summary, summary_tokens FROM messages WHERE chat_id = ? AND message_id = ?", (chat_id, message_id)).fetchone()
+            if row:
+                node = Node(*row)
+        if node is None:
+            return None
+        if time.time() - node.used_at > self.ttl:
+            self._forget(chat_id, message_id)
+            return None
+        self._remember(chat_id, message_id, node)
+        return node
+
+    def chain(self, chat_id: int, message_id: Optional[int]) -> List[Tuple[int, Node]]:
+        """
+        Messages from message_id up to the root of its thread or its latest summary
+        The whole thread counts as used
+        """
+        chain = []
+        message_ids = []
+        node = self.get(chat_id, message_id)
+        now = time.time()
+        while node is not None:
+            node.used_at = now
+            chain.append((message_id, node))
+            message_ids.append(message_id)
+            if node.summary:
+                break
+            message_id = node.reply_id
+            node = self.get(chat_id, message_id)
+        if self.writer:
+            for i in message_ids:
+                self.writer.execute("UPDATE messages SET used_at = ? WHERE chat_id = ? AND message_id = ?", (now, chat_id, i))
+        return chain
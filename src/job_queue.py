@@ -0,0 +1,150 @@
+import json
+import logging
+import threading
+import time
+from typing import List, Optional
+
+from exceptions import AlreadySeenException, NoCaptionsException, NotYoutubeUrlException, TooExpensiveException
+from sqlite_writer import connect
+
+logger = logging.getLogger('bot.job_queue')
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Errors that are an answer to the user by the kind stored with the job, anything else is FAILED
+ERROR_KINDS = {
+    'already_seen': AlreadySeenException,
+    'not_youtube_url': NotYoutubeUrlException,
+    'no_captions': NoCaptionsException,
+    'too_expensive': TooExpensiveException,
+}
+
+
+def error_kind(e: Exception) -> str:
+    for kind, exception_class in ERROR_KINDS.items():
+        if isinstance(e, exception_class):
+            return kind
+    return FAILED
+
+
+class Job:
+    """Row of the job queue"""
+    __slots__ = ('id', 'kind', 'payload', 'attempts', 'result', 'error_kind', 'error')
+
+    def __init__(self, id: int, kind: str, payload: str, attempts: int, result: str=None, error_kind: str=None, error: str=None) -> None:
+        self.id = id
+        self.kind = kind
+        self.payload = json.loads(payload)
+        self.attempts = attempts
+        self.result = result
+        self.error_kind = error_kind
+        self.error = error
+
+    def exception(self) -> Optional[Exception]:
+        """The error the job finished with, rebuilt from its kind"""
+        if self.error_kind is None:
+            return None
+        return ERROR_KINDS.get(self.error_kind, Exception)(self.error)
+
+
+class JobQueue:
+    """Durable queue in SQLite shared by the bot and worker processes, a claimed job comes back once its visibility timeout passes"""
+    def __init__(self, path: str, visibility_timeout: float=900, max_attempts: int=3, retry_delay: float=5) -> None:
+        """Construct a :class:`JobQueue <JobQueue>`.
+
+        :param path:
+            SQLite file every process opens
+        :param visibility_timeout:
+            Seconds a claimed job stays hidden, a worker that dies leaves it to be claimed again after that
+        :param max_attempts:
+            Claims after which a job is failed for good
+        :param retry_delay:
+            Seconds before a failed attempt is retried, doubled on every attempt
+        """
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # Calls come from worker threads, one at a time keeps transactions on the connection apart
+        self.lock = threading.Lock()
+        self.db = connect(path)
+        # Autocommit mode, every write below is its own transaction unless it begins one
+        self.db.isolation_level = None
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, payload TEXT, dedupe_key TEXT UNIQUE, status TEXT, attempts INTEGER DEFAULT 0,
+            visible_at REAL, created_at REAL, finished_at REAL, result TEXT, error_kind TEXT, error TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, visible_at)")
+
+    def put(self, kind: str, payload: dict, dedupe_key: str=None) -> Optional[int]:
+        """Queue a job, None when a job with the same dedupe_key is not delivered yet"""
+        with self.lock:
+            now = time.time()
+            cursor = self.db.execute("INSERT OR IGNORE INTO jobs (kind, payload, dedupe_key, status, visible_at, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                                     (kind, json.dumps(payload), dedupe_key, QUEUED, now, now))
+            if not cursor.rowcount:
+                return None
+            return cursor.lastrowid
+
+    def claim(self) -> Optional[Job]:
+        """Take the oldest visible job, expired claims of dead workers included"""
+        with self.lock:
+            now = time.time()
+            # The write lock is taken up front, so no other process claims the same row in between
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                # Claims that ran out of attempts are not retried again
+                self.db.execute("UPDATE jobs SET status = ?, error_kind = ?, error = ?, finished_at = ? WHERE status = ? AND visible_at <= ? AND attempts >= ?",
+                                (FAILED, FAILED, "Worker did not finish the job", now, RUNNING, now, self.max_attempts))
+                row = self.db.execute("SELECT id, kind, payload, attempts FROM jobs WHERE status IN (?, ?) AND visible_at <= ? ORDER BY id LIMIT 1",
+                                      (QUEUED, RUNNING, now)).fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, visible_at = ? WHERE id = ? AND status IN (?, ?)",
+                                    (RUNNING, now + self.visibility_timeout, row[0], QUEUED, RUNNING))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            if row is None:
+                return None
+            job_id, kind, payload, attempts = row
+            if attempts > 0:
+                logger.info(f"Job {job_id} is claimed again, attempt {attempts + 1}")
+            return Job(job_id, kind, payload, attempts + 1)
+
+    def extend(self, job_id: int) -> None:
+        """Keep a long job hidden while its worker is alive"""
+        with self.lock:
+            self.db.execute("UPDATE jobs SET visible_at = ? WHERE id = ? AND status = ?", (time.time() + self.visibility_timeout, job_id, RUNNING))
+
+    def complete(self, job_id: int, result: str=None, error: Exception=None) -> None:
+        """Store the outcome, an error here is final and reported to the user as it is"""
+        with self.lock:
+            kind = error_kind(error) if error else None
+            self.db.execute("UPDATE jobs SET status = ?, result = ?, error_kind = ?, error = ?, finished_at = ? WHERE id = ?",
+                            (DONE, result, kind, str(error) if error else None, time.time(), job_id))
+
+    def retry(self, job: Job, error: Exception) -> None:
+        """Give the job back for another attempt, or fail it once attempts are used up"""
+        with self.lock:
+            if job.attempts >= self.max_attempts:
+                self.db.execute("UPDATE jobs SET status = ?, error_kind = ?, error = ?, finished_at = ? WHERE id = ?", (FAILED, error_kind(error), str(error), time.time(), job.id))
+                return
+            visible_at = time.time() + self.retry_delay * 2 ** (job.attempts - 1)
+            self.db.execute("UPDATE jobs SET status = ?, error_kind = ?, error = ?, visible_at = ? WHERE id = ?", (QUEUED, error_kind(error), str(error), visible_at, job.id))
+
+    def finished(self, limit: int=50) -> List[Job]:
+        """Finished jobs whose outcome was not delivered yet"""
+        with self.lock:
+            rows = self.db.execute("SELECT id, kind, payload, attempts, result, error_kind, error FROM jobs WHERE status IN (?, ?) ORDER BY id LIMIT ?", (DONE, FAILED, limit))
+            return [Job(*row) for row in rows]
+
+    def acknowledge(self, job_id: int) -> None:
+        """Forget a job once its outcome is delivered"""
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def depth(self) -> int:
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)).fetchone()[0]
@@ -0,0 +1,139 @@
+import asyncio
+from collections import OrderedDict, deque
+import logging
+import time
+from typing import Dict, List
+
+from metrics import LLM_QUEUE_DEPTH
+
+logger = logging.getLogger('bot.llm_scheduler')
+
+# Lanes in the order they are served
+INTERACTIVE = 0
+BULK = 1
+LANE_NAMES = {INTERACTIVE: 'interactive', BULK: 'bulk'}
+
+
+def estimate_tokens(messages: List[dict]) -> int:
+    """Cheap upper estimate of prompt tokens, good enough for rate limiting"""
+    return sum(len(message["content"]) // 3 + 4 for message in messages)
+
+
+class TokenBucket:
+    """Budget that refills continuously up to its per minute capacity"""
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: int) -> float:
+        """Seconds until amount is available, a request above the capacity waits for a full bucket"""
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) / self.rate
+
+    def take(self, amount: int) -> None:
+        self.available -= min(amount, self.capacity)
+
+
+class LLMScheduler:
+    """Shared gate for LLM backend calls with request and token budgets, priority lanes and per chat fairness"""
+    def __init__(self, requests_per_minute: int=500, tokens_per_minute: int=1000000, completion_tokens: int=1000, bulk_every: int=4) -> None:
+        """Construct a :class:`LLMScheduler <LLMScheduler>`.
+
+        :param requests_per_minute:
+            Requests allowed per minute by the provider
+        :param tokens_per_minute:
+            Tokens allowed per minute by the provider, prompt and completion together
+        :param completion_tokens:
+            Tokens reserved for the completion of every request, the prompt is only part of the cost
+        :param bulk_every:
+            A waiting bulk request is served after this many interactive ones in a row, so bulk work is never starved
+        """
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.completion_tokens = completion_tokens
+        self.bulk_every = bulk_every
+        # Interactive requests dispatched since the last bulk one
+        self.interactive_streak = 0
+        # Every lane keeps a queue per chat, chats are served round robin
+        self.lanes = {INTERACTIVE: OrderedDict(), BULK: OrderedDict()}
+        self.wakeup = asyncio.Event()
+        self.worker = None
+        self.dispatched = {INTERACTIVE: 0, BULK: 0}
+
+    def queue_depth(self) -> Dict[str, int]:
+        """Number of waiting requests per lane"""
+        return {LANE_NAMES[priority]: sum(len(queue) for queue in chats.values()) for priority, chats in self.lanes.items()}
+
+    def report_depth(self) -> None:
+        for lane, depth in self.queue_depth().items():
+            LLM_QUEUE_DEPTH.labels(lane).set(depth)
+
+    async def acquire(self, priority: int, chat_id: int, tokens: int) -> None:
+        """Wait until the request may be sent to the backend"""
+        future = asyncio.get_running_loop().create_future()
+        self.lanes[priority].setdefault(chat_id, deque()).append((future, tokens + self.completion_tokens))
+        self.report_depth()
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.dispatch())
+        self.wakeup.set()
+        started = time.monotonic()
+        await future
+        waited = time.monotonic() - started
+        if waited > 1:
+            logger.info(f"Waited {waited:.1f}s in {LANE_NAMES[priority]} lane, queue depth {self.queue_depth()}")
+
+    def next_request(self):
+        """Head of the next chat queue in the most important non empty lane, bulk goes first once its turn comes"""
+        order = (BULK, INTERACTIVE) if self.interactive_streak >= self.bulk_every else (INTERACTIVE, BULK)
+        for priority in order:
+            chats = self.lanes[priority]
+            while chats:
+                chat_id, queue = next(iter(chats.items()))
+                while queue and queue[0][0].done():
+                    # The caller is gone
+                    queue.popleft()
+                if queue:
+                    return priority, chat_id, queue
+                del chats[chat_id]
+        return None
+
+    async def dispatch(self) -> None:
+        while True:
+            head = self.next_request()
+            if head is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            priority, chat_id, queue = head
+            future, tokens = queue[0]
+            delay = max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if delay > 0:
+                # Wake up earlier when a new request arrives, it may be more important
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            queue.popleft()
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.dispatched[priority] += 1
+            self.interactive_streak = self.interactive_streak + 1 if priority == INTERACTIVE else 0
+            chats = self.lanes[priority]
+            if queue:
+                chats.move_to_end(chat_id)
+            else:
+                del chats[chat_id]
+            self.report_depth()
+            future.set_result(None)
@@ -0,0 +1,74 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+logger = logging.getLogger('bot.metrics')
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+STAGE_SECONDS = Histogram('summarizer_stage_seconds', "Latency of pipeline stages", ['stage'], buckets=BUCKETS)
+HANDLER_SECONDS = Histogram('bot_handler_seconds', "Latency of Telegram handlers", ['handler'], buckets=BUCKETS)
+TOKENS = Counter('summarizer_tokens_total', "Tokens by kind, estimated before sending or reported in completion.usage", ['kind'])
+CACHE = Counter('summarizer_cache_total', "Cache lookups by cache and result", ['cache', 'result'])
+ERRORS = Counter('bot_errors_total', "Errors reported to users by exception type", ['exception'])
+LLM_QUEUE_DEPTH = Gauge('llm_queue_depth', "Requests waiting in the LLM scheduler", ['lane'])
+TELEGRAM_RETRY_AFTER = Counter('telegram_retry_after_total', "Sends rejected by Telegram flood control")
+UPDATES_WAITING = Gauge('bot_updates_waiting', "Updates waiting for a worker by lane, not counting the ones waiting for their chat", ['lane'])
+
+# Set once the bot is initialized, /healthz answers 503 until then
+READY = threading.Event()
+
+
+def stage(name: str):
+    """Time a block of code as a pipeline stage, works around await too"""
+    return STAGE_SECONDS.labels(name).time()
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    CACHE.labels(cache, 'hit' if hit else 'miss').inc()
+
+def record_usage(usage) -> None:
+    """Count the real token usage reported by the backend"""
+    if usage is None:
+        return
+    TOKENS.labels('prompt').inc(usage.prompt_tokens or 0)
+    TOKENS.labels('completion').inc(usage.completion_tokens or 0)
+    # DeepSeek reports prompt cache hits at the top level, OpenAI in prompt_tokens_details
+    cached = getattr(usage, 'prompt_cache_hit_tokens', None)
+    if cached is None:
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = getattr(details, 'cached_tokens', None)
+    TOKENS.labels('prompt_cached').inc(cached or 0)
+
+def count_error(e: Exception) -> None:
+    ERRORS.labels(type(e).__name__).inc()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        logger.debug(format % args)
+
+    def do_GET(self) -> None:
+        if self.path == '/metrics':
+            body, content_type, status = generate_latest(), CONTENT_TYPE_LATEST, 200
+        elif self.path == '/healthz':
+            ready = READY.is_set()
+            body, content_type, status = b'ok' if ready else b'starting', 'text/plain', 200 if ready else 503
+        else:
+            self.send_error(404)
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(host: str='127.0.0.1', port: int=9100) -> ThreadingHTTPServer:
+    """Serve /metrics and /healthz from a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Metrics are served on http://{host}:{port}/metrics")
+    return server
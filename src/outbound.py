@@ -0,0 +1,150 @@
+import asyncio
+from collections import deque
+import logging
+import time
+from typing import Any, Awaitable, Callable, Deque, Dict, List
+
+from telegram import Bot, Message
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+from metrics import stage, STAGE_SECONDS, TELEGRAM_RETRY_AFTER
+
+logger = logging.getLogger('bot.outbound')
+
+# Telegram allows 4096 characters, leave room for entities and cost lines
+MESSAGE_SIZE = 3500
+
+
+def split_message(text: str, size: int=MESSAGE_SIZE) -> List[str]:
+    """Split text into messages, preferably between paragraphs, then lines, then words"""
+    pieces = []
+    while len(text) > size:
+        for separator in ("\n\n", "\n", " "):
+            cut = text.rfind(separator, 0, size)
+            # A cut too early would leave a tiny message
+            if cut >= size // 2:
+                break
+        else:
+            cut = size
+        piece = text[:cut].rstrip()
+        # A run of separators leaves nothing to send
+        if piece:
+            pieces.append(piece)
+        text = text[cut:].lstrip()
+    if text.strip():
+        pieces.append(text)
+    return pieces
+
+
+class OutboundSender:
+    """Queue of outgoing messages per chat that keeps within Telegram rate limits"""
+    def __init__(self, bot: Bot, messages_per_second: float=30, private_interval: float=1.0, group_interval: float=3.0, max_retries: int=3) -> None:
+        """Construct a :class:`OutboundSender <OutboundSender>`.
+
+        :param bot:
+            Bot to send messages with
+        :param messages_per_second:
+            Messages per second over all chats
+        :param private_interval:
+            Seconds between messages in a private chat
+        :param group_interval:
+            Seconds between messages in a group, Telegram allows 20 per minute
+        :param max_retries:
+            Retries of a request after flood control or connection errors
+        """
+        self.bot = bot
+        self.global_interval = 1 / messages_per_second
+        self.private_interval = private_interval
+        self.group_interval = group_interval
+        self.max_retries = max_retries
+        self.chats: Dict[int, Deque[tuple]] = {}
+        # Earliest time the next message may go to the chat
+        self.next_send: Dict[int, float] = {}
+        self.next_global = 0.0
+        self.global_lock = asyncio.Lock()
+
+    async def send(self, chat_id: int, text: str, reply_to_message_id: int=None, entities=None) -> List[Message]:
+        """
+        Queue text for the chat and wait until all its messages are sent
+        Messages of one chat go out in the order they were queued
+        """
+        pieces = split_message(text)
+        if not pieces:
+            return []
+        # Entity offsets are only valid when the text is not split
+        entities = entities if len(pieces) == 1 else None
+        future = asyncio.get_running_loop().create_future()
+        queue = self.chats.get(chat_id)
+        if queue is None:
+            queue = self.chats[chat_id] = deque()
+            asyncio.create_task(self.drain(chat_id, queue))
+        queue.append((pieces, reply_to_message_id, entities, future, time.monotonic()))
+        return await future
+
+    async def drain(self, chat_id: int, queue: Deque[tuple]) -> None:
+        try:
+            while queue:
+                pieces, reply_to_message_id, entities, future, queued_at = queue[0]
+                messages = []
+                try:
+                    for piece in pieces:
+                        messages.append(await self.deliver(chat_id, piece, reply_to_message_id, entities))
+                    if not future.done():
+                        future.set_result(messages)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                queue.popleft()
+                STAGE_SECONDS.labels('telegram_delivery').observe(time.monotonic() - queued_at)
+                if not queue:
+                    # Stay until the chat may be sent to again, so its pacing is not forgotten
+                    await asyncio.sleep(max(0.0, self.next_send.get(chat_id, 0) - time.monotonic()))
+        finally:
+            del self.chats[chat_id]
+            self.next_send.pop(chat_id, None)
+
+    async def wait_turn(self, chat_id: int) -> None:
+        delay = self.next_send.get(chat_id, 0) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with self.global_lock:
+            delay = self.next_global - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_global = time.monotonic() + self.global_interval
+        # Group chats have negative ids
+        self.next_send[chat_id] = time.monotonic() + (self.group_interval if chat_id < 0 else self.private_interval)
+        if len(self.next_send) > len(self.chats) + 1000:
+            # Chats only edited through request have no drain task to forget their pacing
+            now = time.monotonic()
+            for stale in [chat for chat, at in self.next_send.items() if at < now and chat not in self.chats]:
+                del self.next_send[stale]
+
+    async def request(self, chat_id: int, call: Callable[[], Awaitable[Any]], retries: int=None, name: str='telegram_send') -> Any:
+        """
+        Make a Bot API call for the chat at the chat's pace, outside of its message queue
+        Flood control and connection errors are retried up to retries times, max_retries by default
+        """
+        retries = self.max_retries if retries is None else retries
+        for attempt in range(retries + 1):
+            await self.wait_turn(chat_id)
+            try:
+                with stage(name):
+                    return await call()
+            except RetryAfter as e:
+                TELEGRAM_RETRY_AFTER.inc()
+                logger.info(f"Flood control in {chat_id}, retry in {e.retry_after}s")
+                self.next_send[chat_id] = time.monotonic() + e.retry_after
+                if attempt == retries:
+                    raise
+            except (BadRequest, TimedOut):
+                # A timed out request may have gone through, repeating it could post the message twice
+                raise
+            except NetworkError as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f"Request to {chat_id} failed, retrying: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+    async def deliver(self, chat_id: int, text: str, reply_to_message_id: int, entities) -> Message:
+        return await self.request(chat_id, lambda: self.bot.send_message(chat_id, text=text, reply_to_message_id=reply_to_message_id, entities=entities))
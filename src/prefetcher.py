@@ -0,0 +1,96 @@
+import asyncio
+from collections import OrderedDict
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from metrics import cache_lookup, stage
+from tokenized_document import TokenizedDocument
+
+logger = logging.getLogger('bot.prefetcher')
+
+# Language, captions and the tokenized transcript
+Prefetched = Tuple[str, List[dict], TokenizedDocument]
+
+
+def prefetched_size(entry: Prefetched) -> int:
+    """Rough memory footprint in bytes, token lists dominate with an int object and a pointer per token"""
+    _, captions, document = entry
+    caption_chars = sum(len(caption['text']) for caption in captions)
+    return 2 * caption_chars + 2 * len(document.text) + 36 * document.token_count
+
+
+class TranscriptPrefetcher:
+    """Loads transcripts in the background before they are asked for, keeps them within a memory budget"""
+    def __init__(self, load: Callable[[str], Awaitable[Optional[Prefetched]]], max_concurrent: int=2, max_bytes: int=64 * 1024 * 1024, max_pending: int=16) -> None:
+        """Construct a :class:`TranscriptPrefetcher <TranscriptPrefetcher>`.
+
+        :param load:
+            Fetches and tokenizes the transcript of a video id, None leaves nothing to keep
+        :param max_concurrent:
+            Transcripts loaded at the same time
+        :param max_bytes:
+            Memory budget of loaded transcripts, the least recently used ones are dropped first
+        :param max_pending:
+            Videos waiting to be loaded, links beyond that are ignored
+        """
+        self.load = load
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self.entries: Dict[str, Tuple[Prefetched, int]] = OrderedDict()
+        self.size = 0
+        self.pending: Dict[str, asyncio.Task] = {}
+        # Pending videos past the semaphore, actually being loaded
+        self.started: Set[str] = set()
+
+    def schedule(self, video_id: str) -> bool:
+        """Start loading the video in the background, False when it is loaded, loading or there are too many"""
+        if video_id in self.entries or video_id in self.pending:
+            return False
+        if len(self.pending) >= self.max_pending:
+            logger.debug(f"Skip prefetching {video_id}, {len(self.pending)} videos are pending")
+            return False
+        self.pending[video_id] = asyncio.create_task(self.prefetch(video_id))
+        return True
+
+    async def prefetch(self, video_id: str) -> None:
+        try:
+            async with self.semaphore:
+                self.started.add(video_id)
+                with stage('prefetch'):
+                    entry = await self.load(video_id)
+            if entry:
+                self.put(video_id, entry)
+        except Exception as e:
+            logger.info(f"Cannot prefetch {video_id}: {e}")
+        finally:
+            del self.pending[video_id]
+            self.started.discard(video_id)
+
+    def put(self, video_id: str, entry: Prefetched) -> None:
+        size = prefetched_size(entry)
+        if size > self.max_bytes:
+            logger.info(f"Transcript of {video_id} does not fit the prefetch budget")
+            return
+        while self.entries and self.size + size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+        self.entries[video_id] = (entry, size)
+        self.size += size
+        logger.info(f"Prefetched {video_id}, {entry[2].token_count} tokens, {self.size // 1024} KiB in use")
+
+    async def get(self, video_id: str) -> Optional[Prefetched]:
+        """Loaded transcript, waits when it is being loaded right now"""
+        task = self.pending.get(video_id)
+        # A task that did not run yet gets a free slot right away
+        if task and (video_id in self.started or not self.semaphore.locked()):
+            await asyncio.shield(task)
+        elif task:
+            # Still queued behind other loads, the caller is better off fetching it directly
+            task.cancel()
+        item = self.entries.get(video_id)
+        cache_lookup('prefetch', item is not None)
+        if item is None:
+            return None
+        self.entries.move_to_end(video_id)
+        return item[0]
@@ -0,0 +1,83 @@
+from collections import Counter
+import logging
+import math
+import re
+from typing import List, Optional
+
+from tokenized_document import TokenizedDocument
+
+logger = logging.getLogger('bot.retrieval')
+
+WORD = re.compile(r'\w+')
+# Crude stemming by prefix, good enough to match inflected Russian words
+STEM_LENGTH = 6
+# Best window scoring below this means the question is not clearly covered by any part
+MIN_SCORE = 1.0
+
+
+def terms(text: str) -> List[str]:
+    """Lowercased word prefixes, timestamps and other numbers are skipped"""
+    return [word[:STEM_LENGTH] for word in WORD.findall(text.lower()) if not word.isdigit()]
+
+
+class TranscriptIndex:
+    """BM25 index over consecutive windows of a transcript"""
+    def __init__(self, document: TokenizedDocument, window_tokens: int=1000, k1: float=1.5, b: float=0.75) -> None:
+        """Construct a :class:`TranscriptIndex <TranscriptIndex>`.
+
+        :param document:
+            Tokenized transcript, windows are made of its whole segments
+        :param window_tokens:
+            Size of a window in tokens
+        :param k1:
+            BM25 term frequency saturation
+        :param b:
+            BM25 length normalization
+        """
+        self.k1 = k1
+        self.b = b
+        self.windows = [
+            document.text[document.offsets[start] : document.offsets[end]]
+            for start, end in document.chunk_bounds(window_tokens, overlap=1)
+        ]
+        self.term_freqs = [Counter(terms(window)) for window in self.windows]
+        self.lengths = [sum(term_freq.values()) for term_freq in self.term_freqs]
+        self.average_length = sum(self.lengths) / max(len(self.lengths), 1)
+        self.doc_freq = Counter()
+        for term_freq in self.term_freqs:
+            self.doc_freq.update(term_freq.keys())
+
+    def idf(self, term: str) -> float:
+        n = len(self.windows)
+        df = self.doc_freq.get(term, 0)
+        return math.log((n - df + 0.5) / (df + 0.5) + 1)
+
+    def scores(self, query: str) -> List[float]:
+        query_terms = set(terms(query))
+        scores = []
+        for term_freq, length in zip(self.term_freqs, self.lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / max(self.average_length, 1))
+            for term in query_terms:
+                freq = term_freq.get(term, 0)
+                if freq:
+                    score += self.idf(term) * freq * (self.k1 + 1) / (freq + norm)
+            scores.append(score)
+        return scores
+
+    def search(self, query: str, top_k: int=4) -> Optional[str]:
+        """
+        Return the top_k windows in transcript order
+        Return None when the full transcript should be used instead:
+        it is not longer than top_k windows or no window matches the query well enough
+        """
+        if len(self.windows) <= top_k:
+            return None
+        scores = self.scores(query)
+        best = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_k]
+        if scores[best[0]] < MIN_SCORE:
+            logger.info(f"Low retrieval confidence {scores[best[0]]:.2f} for \"{query}\"")
+            return None
+        best = sorted(i for i in best if scores[i] > 0)
+        logger.info(f"Retrieved windows {best} out of {len(self.windows)} for \"{query}\"")
+        return "...\n".join(self.windows[i] for i in best)
@@ -0,0 +1,61 @@
+from collections import OrderedDict, defaultdict
+import logging
+import time
+
+from sqlite_writer import connect, WriteBehind
+
+logger = logging.getLogger('bot.seen_registry')
+
+
+class SeenRegistry:
+    """Videos already summarized per chat, bounded by TTL and size, optionally backed by SQLite"""
+    def __init__(self, ttl: int=30 * 24 * 3600, max_per_chat: int=1000, path: str=None) -> None:
+        """Construct a :class:`SeenRegistry <SeenRegistry>`.
+
+        :param ttl:
+            Seconds after which a video may be summarized again in the same chat
+        :param max_per_chat:
+            How many videos are remembered per chat, the oldest ones are forgotten first
+        :param path:
+            (Optional) SQLite file to keep the registry across restarts
+        """
+        self.ttl = ttl
+        self.max_per_chat = max_per_chat
+        self.chats = defaultdict(OrderedDict)
+        self.writer = None
+        if path:
+            db = connect(path)
+            db.execute("CREATE TABLE IF NOT EXISTS seen (chat_id INTEGER, video_id TEXT, seen_at REAL, PRIMARY KEY (chat_id, video_id))")
+            db.execute("DELETE FROM seen WHERE seen_at < ?", (time.time() - ttl,))
+            db.commit()
+            # Writes are committed off the event loop, reads only happen here
+            self.writer = WriteBehind(path)
+            for chat_id, video_id, seen_at in db.execute("SELECT chat_id, video_id, seen_at FROM seen ORDER BY seen_at").fetchall():
+                self._remember(chat_id, video_id, seen_at)
+            logger.info(f"Loaded seen videos for {len(self.chats)} chats")
+            db.close()
+
+    def _remember(self, chat_id: int, video_id: str, seen_at: float) -> None:
+        videos = self.chats[chat_id]
+        videos[video_id] = seen_at
+        videos.move_to_end(video_id)
+        while len(videos) > self.max_per_chat:
+            forgotten, _ = videos.popitem(last=False)
+            if self.writer:
+                self.writer.execute("DELETE FROM seen WHERE chat_id = ? AND video_id = ?", (chat_id, forgotten))
+
+    def contains(self, chat_id: int, video_id: str) -> bool:
+        """Check without any I/O whether the video was summarized in the chat within TTL"""
+        videos = self.chats.get(chat_id)
+        if not videos or video_id not in videos:
+            return False
+        if time.time() - videos[video_id] > self.ttl:
+            del videos[video_id]
+            return False
+        return True
+
+    def add(self, chat_id: int, video_id: str) -> None:
+        seen_at = time.time()
+        self._remember(chat_id, video_id, seen_at)
+        if self.writer:
+            self.writer.execute("INSERT OR REPLACE INTO seen (chat_id, video_id, seen_at) VALUES (?, ?, ?)", (chat_id, video_id, seen_at))
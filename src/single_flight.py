@@ -0,0 +1,51 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from completion import Progress, Render
+from metrics import cache_lookup
+
+logger = logging.getLogger('bot.single_flight')
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into a single execution"""
+    def __init__(self) -> None:
+        self.calls = {}
+        # Progress callbacks of every caller waiting on a key
+        self.listeners: Dict[Hashable, List[Progress]] = {}
+
+    async def do(self, key: Hashable, func: Callable[[Optional[Progress]], Awaitable[Any]], on_progress: Progress=None) -> Any:
+        """
+        Run func for the first caller of a key
+        Every caller arriving while it is in flight awaits the same future
+        Progress of the run goes to every caller that passed on_progress, when the first caller asked for it
+        """
+        future = self.calls.get(key)
+        cache_lookup('inflight', future is not None)
+        listeners = self.listeners.setdefault(key, [])
+        if on_progress:
+            listeners.append(on_progress)
+        if future is None:
+            future = asyncio.ensure_future(func(self._broadcast(listeners) if on_progress else None))
+            self.calls[key] = future
+            future.add_done_callback(lambda _: (self.calls.pop(key, None), self.listeners.pop(key, None)))
+        else:
+            logger.info(f"Joining in-flight request for {key}")
+        try:
+            # Shield so that one cancelled caller does not cancel the work for the others
+            return await asyncio.shield(future)
+        finally:
+            if on_progress in listeners:
+                listeners.remove(on_progress)
+
+    @staticmethod
+    def _broadcast(listeners: List[Progress]) -> Progress:
+        async def progress(render: Render) -> None:
+            for listener in list(listeners):
+                try:
+                    await listener(render)
+                except Exception as e:
+                    # A reply that cannot be edited must not fail the shared work
+                    logger.warning(f"Progress update failed: {e}")
+        return progress
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import os
+import sqlite3
+from typing import List, Tuple
+
+logger = logging.getLogger('bot.sqlite_writer')
+
+# Seconds a write waits for another process holding the lock
+BUSY_TIMEOUT = 30
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Connection to a file that several processes may share, WAL lets readers go on while one of them writes"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+class WriteBehind:
+    """Queue of writes that are committed in batches from a worker thread, off the event loop"""
+    def __init__(self, path: str) -> None:
+        """Construct a :class:`WriteBehind <WriteBehind>`.
+
+        :param path:
+            SQLite file, written through a connection of its own
+        """
+        self.db = connect(path)
+        self.pending: List[Tuple[str, tuple]] = []
+        self.flushing = None
+
+    def execute(self, sql: str, params: tuple=()) -> None:
+        """Queue a write, it is committed right away when there is no event loop"""
+        self.pending.append((sql, params))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_now()
+            return
+        if self.flushing is None or self.flushing.done():
+            self.flushing = loop.create_task(self.flush())
+
+    async def flush(self) -> None:
+        # Writes queued while a batch is committed go with the next one
+        while self.pending:
+            batch, self.pending = self.pending, []
+            await asyncio.to_thread(self.commit, batch)
+
+    def flush_now(self) -> None:
+        batch, self.pending = self.pending, []
+        self.commit(batch)
+
+    def commit(self, batch: List[Tuple[str, tuple]]) -> None:
+        try:
+            for sql, params in batch:
+                self.db.execute(sql, params)
+            self.db.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Dropped {len(batch)} writes: {e}")
+            self.db.rollback()
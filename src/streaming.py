@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from typing import List
+
+from telegram import Message
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from completion import Render
+from outbound import OutboundSender, split_message
+
+logger = logging.getLogger('bot.streaming')
+
+PLACEHOLDER = "..."
+
+
+class StreamingReply:
+    """Telegram reply that grows while the model is still generating"""
+    def __init__(self, sender: OutboundSender, chat_id: int, reply_to_message_id: int, min_interval: float=2.0) -> None:
+        """Construct a :class:`StreamingReply <StreamingReply>`.
+
+        :param sender:
+            Sender whose bot, chat pacing and retries the messages are sent and edited with
+        :param chat_id:
+            Chat to reply in
+        :param reply_to_message_id:
+            Message the reply is attached to
+        :param min_interval:
+            Seconds between edits, keeps the bot within Telegram edit rate limits
+        """
+        self.sender = sender
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.min_interval = min_interval
+        self.messages: List[Message] = []
+        # Text currently shown in every message
+        self.shown: List[str] = []
+        self.last_edit = 0.0
+        self.lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        """Send the placeholder the output is streamed into"""
+        await self._send(PLACEHOLDER)
+
+    async def _send(self, text: str, retries: int=None) -> None:
+        bot = self.sender.bot
+        message = await self.sender.request(self.chat_id, lambda: bot.send_message(self.chat_id, reply_to_message_id=self.reply_to_message_id, text=text), retries)
+        self.messages.append(message)
+        self.shown.append(text)
+
+    async def _edit(self, i: int, text: str, retries: int=None) -> None:
+        if self.shown[i] == text:
+            return
+        bot = self.sender.bot
+        message_id = self.messages[i].message_id
+        try:
+            await self.sender.request(self.chat_id, lambda: bot.edit_message_text(text, chat_id=self.chat_id, message_id=message_id), retries, 'telegram_edit')
+            self.shown[i] = text
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+
+    async def _render(self, text: str, retries: int=None) -> None:
+        """Fill the messages with text, split the same way the outbound sender splits replies"""
+        pieces = split_message(text) or [PLACEHOLDER]
+        for i, piece in enumerate(pieces):
+            if i < len(self.messages):
+                await self._edit(i, piece, retries)
+            else:
+                await self._send(piece, retries)
+        self.last_edit = time.monotonic()
+
+    async def update(self, render: Render) -> None:
+        """Show partial text, skipped when the previous edit was too recent or one is in progress, the text is only rendered when shown"""
+        if time.monotonic() - self.last_edit < self.min_interval or self.lock.locked():
+            return
+        async with self.lock:
+            try:
+                # Partial text is not worth waiting for, flood control skips it
+                await self._render(render(), retries=0)
+            except RetryAfter as e:
+                logger.debug(f"Edits are throttled for {e.retry_after}s")
+                self.last_edit = time.monotonic() + e.retry_after
+            except NetworkError as e:
+                # The next update or finish shows the text anyway
+                logger.info(f"Skipped a partial update in {self.chat_id}: {e}")
+
+    async def finish(self, text: str) -> List[Message]:
+        """Show the final text whatever the throttling is and return the messages holding it"""
+        async with self.lock:
+            while True:
+                try:
+                    await self._render(text)
+                    break
+                except RetryAfter as e:
+                    await asyncio.sleep(e.retry_after)
+        pieces = max(1, len(split_message(text)))
+        # The final text may be shorter than the streamed one
+        for message in self.messages[pieces:]:
+            await self.sender.request(self.chat_id, message.delete, name='telegram_delete')
+        del self.messages[pieces:], self.shown[pieces:]
+        return self.messages
@@ -1,27 +1,53 @@
+import asyncio
 import collections
 from html import unescape
 import logging
 import os
 import re
-import time
-from typing import List
+from typing import List, Tuple, Union
 from xml.etree import ElementTree
-from openai import OpenAI
+from openai import AsyncOpenAI
 from urllib.parse import urlparse
 
-from youtube_transcript_api import YouTubeTranscriptApi
-from youtube_transcript_api.formatters import SRTFormatter
-
 import tiktoken
+from compaction import compact_captions
+from completion import complete, Progress, Render
 from exceptions import *
+from llm_scheduler import BULK, LLMScheduler, estimate_tokens
+from metrics import cache_lookup, stage, TOKENS
+from prefetcher import Prefetched, TranscriptPrefetcher
+from retrieval import TranscriptIndex
+from seen_registry import SeenRegistry
+from single_flight import SingleFlight
+from summary_cache import SummaryCache
+from tokenized_document import TokenizedDocument
+from transcript_cache import TranscriptCache
+from transcript_fetcher import TranscriptFetcher
 
 logger = logging.getLogger('bot.summarizer')
 
-PROMPT_RU = "Это транскрипция видео в формате SRT. Напиши главные тезисы взятые из текста и поставь временную метку начала тезиса"
+PROMPT_RU = "Это транскрипция видео {format}. Напиши главные тезисы взятые из текста и поставь временную метку начала тезиса"
 # PROMPT_RU = "Напиши главные тезисы из текста."
 FINAL_PROMPT_RU = "Пронумеруй каждый тезис заново."
-PROMPT_EN = "This is a transcript in SRT format. Summarize main points from the text and add the timestamps for each point."
+PROMPT_EN = "This is a transcript {format}. Summarize main points from the text and add the timestamps for each point."
 FINAL_PROMPT_EN = "Renumerate each point again."
+REDUCE_PROMPT_RU = "Это тезисы из частей одного видео. Объедини их в общий список, убери повторы и сохрани временные метки."
+REDUCE_PROMPT_EN = "These are main points from parts of one video. Merge them into one list, drop repeats and keep the timestamps."
+# The question goes after the transcript, so repeated /clarify calls share the prompt and transcript prefix
+CLARIFY_PROMPT_RU = "Это транскрипция к видео {format}. Проанализируй текст и перескажи что говорится про тему из вопроса. Покажи временные метки где об этом говорится. Если об этом ничего нет напиши 'NOT_FOUND'"
+CLARIFY_PROMPT_EN = "This is transcript from video {format}. Show the timestamp where it says about the topic of the question. If there is nothing about it in the video write 'NOT_FOUND'"
+CLARIFY_QUESTION_RU = "Вопрос: \"{clarify}\""
+CLARIFY_QUESTION_EN = "Question: {clarify}"
+# How the transcript is laid out, plain SRT or compacted lines
+TRANSCRIPT_FORMAT = {
+   'ru': {'srt': "в формате SRT", 'compact': "где каждая строка начинается с временной метки [мм:сс] или [ч:мм:сс]"},
+   'en': {'srt': "in SRT format", 'compact': "where each line starts with a [mm:ss] or [h:mm:ss] timestamp"},
+}
+
+LANGUAGES = ['ru', 'en']
+# How many per video /clarify indexes are kept in memory
+INDEX_CACHE_SIZE = 32
+CACHED_COST_LINE = "\n\nС вас 0 руб. (уже было в кэше)"
 
 PRICE = {'gpt-3.5-turbo': 0.0005, 'gpt-4o': 0.005, 'gpt-4o-mini': 0.00015, 'deepseek-chat': 0.00007}
 
@@ -44,9 +70,9 @@ def get_youtube_video_id(url:str) -> str:
    else:
       return False
 
-def calculate_cost(tokens: List[int], chat_model: str) -> int:
+def calculate_cost(token_count: int, chat_model: str) -> int:
    """Cost calculation in rub"""   
-   size = len(tokens) / 1000
+   size = token_count / 1000
    cost = size * PRICE[chat_model]
    return int(cost * 100 * 1.1) + 1
 
@@ -60,84 +86,229 @@ def xml_caption_to_text(xml_captions: str) -> str:
       segments.append(caption)
    return "\n".join(segments).strip()
 
+def srt_timestamp(seconds: float) -> str:
+   """Format seconds as an SRT timestamp"""
+   hours, remainder = divmod(float(seconds), 3600)
+   mins, secs = divmod(remainder, 60)
+   ms = int(round((seconds - int(seconds)) * 1000, 2))
+   return f"{int(hours):02d}:{int(mins):02d}:{int(secs):02d},{ms:03d}"
+
+def captions_to_srt_cues(captions: List[dict]) -> Tuple[List[str], List[float]]:
+   """
+   Format every caption as its own SRT cue, same as SRTFormatter does for the whole transcript
+   Measure the silence before each cue to find natural pauses
+   """
+   cues, pauses = [], []
+   previous_end = 0.0
+   for i, line in enumerate(captions):
+      end = line["start"] + line["duration"]
+      shown_until = captions[i + 1]["start"] if i < len(captions) - 1 and captions[i + 1]["start"] < end else end
+      cues.append(f"{i + 1}\n{srt_timestamp(line['start'])} --> {srt_timestamp(shown_until)}\n{line['text']}\n\n")
+      pauses.append(max(0.0, line["start"] - previous_end))
+      previous_end = end
+   return cues, pauses
+
 
 class Summarizer:
    """Main summarizer logic."""
 
-   def __init__(self, chat_model: str='deepseek-chat', base_url: str='https://api.deepseek.com', model_token_limit: int=64000, youtube_api_proxies: dict[str, str]=None) -> None:
+   def __init__(self, chat_model: str='deepseek-chat', base_url: str='https://api.deepseek.com', model_token_limit: int=64000, youtube_api_proxies: dict[str, str]=None, max_concurrent_chunks: int=4, chunk_retries: int=2, transcript_cache: TranscriptCache=None, summary_cache: SummaryCache=None, chunk_overlap: int=1, align_to_pauses: bool=True, compact_transcript: bool=True, max_cost: int=10, max_reduce_depth: int=3, reduce_token_budget: int=200000, clarify_top_k: int=4, clarify_window_tokens: int=1000, seen: SeenRegistry=None, scheduler: LLMScheduler=None, prefetch_concurrency: int=2, prefetch_max_bytes: int=0, prefetch_tokenize: bool=True) -> None:
       """Construct a :class:`Summarizer <Summarizer>`.
 
       :param chat_model:
          Type of the backend model to use
       :param model_token_limit:
          Max token limit that backend model supports
+      :param max_concurrent_chunks:
+         How many chunks of one video are summarized in parallel
+      :param chunk_retries:
+         How many times a failed chunk is retried before the whole summary fails
+      :param transcript_cache:
+         (Optional) Cache to look up transcripts in before going to YouTube
+      :param summary_cache:
+         (Optional) Cache of finished summaries shared between chats
+      :param chunk_overlap:
+         How many caption cues of the previous chunk are repeated at the start of the next one
+      :param align_to_pauses:
+         End chunks at the longest pause in speech once they are mostly full
+      :param compact_transcript:
+         Send timestamped lines without rolling caption repeats and filler words instead of SRT
+      :param max_cost:
+         Estimated cost in rub above which a video is refused
+      :param max_reduce_depth:
+         How many levels of merging chunk summaries are allowed
+      :param reduce_token_budget:
+         Total tokens that may be sent while merging chunk summaries
+      :param clarify_top_k:
+         How many transcript windows are sent for /clarify, 0 sends the full transcript
+      :param clarify_window_tokens:
+         Size of a transcript window for /clarify in tokens
+      :param seen:
+         (Optional) Registry of videos already summarized per chat, in memory by default
+      :param scheduler:
+         (Optional) Rate limiter shared with the free chat, chunk calls go to its bulk lane
+      :param prefetch_concurrency:
+         Transcripts prefetched at the same time
+      :param prefetch_max_bytes:
+         Memory budget of prefetched transcripts, 0 disables prefetching
+      :param prefetch_tokenize:
+         Keep prefetched transcripts tokenized in memory, otherwise prefetching only fills the transcript cache
       """
       self.base_url = base_url
       self.chat_model = chat_model
       api_key = os.environ.get('OPENAI_API_KEY', None)
       if not api_key:
          raise Exception("API key is not set in the environment variable OPENAI_API_KEY") 
-      self.client = OpenAI(api_key=api_key, base_url=base_url)
+      self.client = AsyncOpenAI(api_key=api_key, base_url=base_url)
       self.youtube_api_proxies = youtube_api_proxies
+      self.transcript_fetcher = TranscriptFetcher(proxies=youtube_api_proxies)
       self.max_tokens = 50000
       self.model_token_limit = model_token_limit
       self.tokenizer = tiktoken.encoding_for_model('gpt-4o')
-      self.seen = collections.defaultdict(dict)
+      self.seen = seen if seen is not None else SeenRegistry()
+      self.max_concurrent_chunks = max_concurrent_chunks
+      self.chunk_retries = chunk_retries
+      self.transcript_cache = transcript_cache
+      self.summary_cache = summary_cache
+      self.inflight = SingleFlight()
+      self.chunk_overlap = chunk_overlap
+      self.align_to_pauses = align_to_pauses
+      self.compact_transcript = compact_transcript
+      self.max_cost = max_cost
+      self.max_reduce_depth = max_reduce_depth
+      self.reduce_token_budget = reduce_token_budget
+      self.clarify_top_k = clarify_top_k
+      self.clarify_window_tokens = clarify_window_tokens
+      self.indexes = collections.OrderedDict()
+      self.scheduler = scheduler
+      self.prefetch_tokenize = prefetch_tokenize
+      self.prefetcher = None
+      if prefetch_max_bytes:
+         self.prefetcher = TranscriptPrefetcher(self.load_transcript, max_concurrent=prefetch_concurrency, max_bytes=prefetch_max_bytes)
 
-   def split_to_chunks(self, text_data: str, prompt: str) -> List[str]:
+   def split_to_chunks(self, document: TokenizedDocument, prompt: str, question: str=None) -> List[str]:
       """
       Long encoded text won't fit the model, so we need to split based on max token limit
       that model supports
       """
-      token_integers = self.tokenizer.encode(text_data)
       chunk_size = self.max_tokens - len(self.tokenizer.encode(prompt))
-      chunks = [
-         token_integers[i : i + chunk_size]
-         for i in range(0, len(token_integers), chunk_size)
+      if question:
+         chunk_size -= len(self.tokenizer.encode(question))
+      return document.chunks(chunk_size, self.chunk_overlap, self.align_to_pauses)
+
+   async def summarize_chunk(self, chunk: str, prompt: str, semaphore: asyncio.Semaphore, chat_id: int=None, on_delta: Progress=None, question: str=None) -> str:
+      """
+      Generate summary for a single chunk, streamed to on_delta when given
+      Retry only this chunk on failure so the rest of the job is kept
+      The fixed prompt goes first and the question last, so the provider can cache the common prefix
+      """
+      messages = [
+         {"role": "system", "content": prompt},
+         {"role": "user", "content": chunk}
       ]
-      chunks = [self.tokenizer.decode(chunk) for chunk in chunks]
-      return chunks
+      if question:
+         messages.append({"role": "user", "content": question})
+      for attempt in range(self.chunk_retries + 1):
+         try:
+            async with semaphore:
+               if self.scheduler:
+                  await self.scheduler.acquire(BULK, chat_id, estimate_tokens(messages))
+               with stage('llm_chunk'):
+                  _, response = await complete(self.client, self.chat_model, messages, on_delta)
+            return response
+         except Exception as e:
+            if attempt == self.chunk_retries:
+               raise
+            logger.warning(f"Chunk failed on attempt {attempt + 1}, retrying: {e}")
+            await asyncio.sleep(2 ** attempt)
 
-   def summarize(self, context: str, prompt: str, final_prompt: str, cost_estimate: bool=True) -> str:
+   async def reduce(self, responses: List[str], reduce_prompt: str, final_prompt: str, semaphore: asyncio.Semaphore, chat_id: int=None) -> Tuple[str, int]:
+      """
+      Merge chunk summaries level by level in groups that fit the model, until all of them fit one request
+      Stop after max_reduce_depth levels or once reduce_token_budget would be exceeded
+      Apply the final prompt to what is left
+      Return the result and the number of tokens sent on the way
+      """
+      spent = 0
+      chunk_size = self.max_tokens - len(self.tokenizer.encode(reduce_prompt))
+      for depth in range(self.max_reduce_depth):
+         if len(responses) < 2:
+            break
+         document = TokenizedDocument(None, self.tokenizer, segments=[f"{response}\n" for response in responses])
+         if document.token_count <= chunk_size:
+            break
+         if spent + document.token_count > self.reduce_token_budget:
+            logger.warning(f"Reduce budget of {self.reduce_token_budget} tokens is spent at level {depth}")
+            break
+         groups = document.chunks(chunk_size)
+         if len(groups) >= len(responses):
+            break
+         logger.info(f"Reduce level {depth}: merge {len(responses)} summaries into {len(groups)}")
+         spent += document.token_count
+         responses = await asyncio.gather(*(self.summarize_chunk(group, reduce_prompt, semaphore, chat_id) for group in groups))
+
+      joined = "\n".join(responses)
+      if not final_prompt or len(responses) < 2:
+         return joined, spent
+      final_tokens = len(self.tokenizer.encode(joined))
+      if final_tokens > chunk_size or spent + final_tokens > self.reduce_token_budget:
+         logger.warning(f"Skip the final prompt, {final_tokens} tokens do not fit")
+         return joined, spent
+      return await self.summarize_chunk(joined, final_prompt, semaphore, chat_id), spent + final_tokens
+
+   async def summarize(self, context: Union[str, TokenizedDocument], prompt: str, final_prompt: str, cost_estimate: bool=True, cache_key: str=None, reduce_prompt: str=None, chat_id: int=None, on_progress: Progress=None, question: str=None) -> str:
       """
       Split long input to chunks
       Generate summary for individual chunk
+      Merge the summaries with the reduce prompt while they don't fit the model
       Renumerate all output bullet points with the final prompt
+      Store the result in the summary cache under cache_key
+      Stream partial chunk summaries to on_progress when given
+      Ask the question after every chunk when given
       """
-      chunks = self.split_to_chunks(context, prompt)
+      # Encode once, cost and chunking both work from the same tokens
+      document = context
+      if isinstance(context, str):
+         document = await asyncio.to_thread(TokenizedDocument, context, self.tokenizer)
 
-      cost = calculate_cost(self.tokenizer.encode(context), self.chat_model)
-      logger.info(f"Cost is {cost}")
-      if cost > 10:
+      cost = calculate_cost(document.token_count, self.chat_model)
+      logger.info(f"Cost is {cost} for {document.token_count} tokens")
+      if cost > self.max_cost:
          raise TooExpensiveException(cost)
       cost_line = f"\n\nС вас {cost} руб."
 
-      responses = []
-      for i, chunk in enumerate(chunks):
-         logger.info(f"Process chunk {i} out of {len(chunks)}")
-         completion = self.client.chat.completions.create(
-            model=self.chat_model,
-            messages=[
-               {"role": "system", "content": chunk},
-               {"role": "user", "content": prompt}
-            ]
-         )
-         response = completion.choices[0].message.content.strip()
-         responses.append(response)
+      chunks = self.split_to_chunks(document, prompt, question)
+
+      logger.info(f"Process {len(chunks)} chunks, {self.max_concurrent_chunks} at a time")
+      semaphore = asyncio.Semaphore(self.max_concurrent_chunks)
+      partials: List[Render] = [None] * len(chunks)
+
+      def render() -> str:
+         texts = (partial() for partial in partials if partial)
+         return "\n".join(text for text in texts if text)
+
+      def on_delta(i: int):
+         if on_progress is None:
+            return None
+         async def show(partial: Render) -> None:
+            partials[i] = partial
+            await on_progress(render)
+         return show
+
+      # gather keeps the order of chunks, so the reduce step sees them in sequence
+      responses = await asyncio.gather(*(self.summarize_chunk(chunk, prompt, semaphore, chat_id, on_delta(i), question) for i, chunk in enumerate(chunks)))
 
       logger.debug(responses)
       
-      if final_prompt and len(responses) > 1:
-         response = self.client.chat.completions.create(
-            model=self.chat_model,
-            messages=[
-               {"role": "system", "content": "\n".join(responses)},
-               {"role": "user", "content": final_prompt}
-            ]
-         )
-         final_response = response.choices[0].message.content.strip()
-      else:
-         final_response = "\n".join(responses)
+      with stage('reduce'):
+         final_response, reduce_tokens = await self.reduce(responses, reduce_prompt or final_prompt or REDUCE_PROMPT_EN, final_prompt, semaphore, chat_id)
+      if reduce_tokens:
+         cost = calculate_cost(document.token_count + reduce_tokens, self.chat_model)
+         logger.info(f"Cost is {cost} after reducing {reduce_tokens} tokens")
+         cost_line = f"\n\nС вас {cost} руб."
+
+      if self.summary_cache and cache_key:
+         self.summary_cache.put(cache_key, final_response)
 
       if cost_estimate:
          final_response += cost_line
@@ -145,14 +316,28 @@ class Summarizer:
       logger.debug(final_response)
       return final_response
 
-   def get_youtube_summary(self, chat_id: int, text: str, clarify: str=None) -> str:
+   def fetch_captions(self, video_id: str) -> Tuple[str, List[dict]]:
       """
-      Extract captions from a YouTube video for [ru,en] or autogenerated [a.ru,a.en]
-      Strip the timestamps
-      Pass to a model backend
+      Pick a [ru,en] transcript and download its captions
+      Serve them from the transcript cache when it is configured
       """
-      logger.debug(text)
+      if self.transcript_cache:
+         for language in LANGUAGES:
+            captions = self.transcript_cache.get(video_id, language)
+            if captions:
+               logger.info(f"Transcript cache hit for {video_id} [{language}]")
+               cache_lookup('transcript', True)
+               return language, captions
+         cache_lookup('transcript', False)
 
+      with stage('transcript_fetch'):
+         language, captions = self.transcript_fetcher.fetch(video_id, LANGUAGES)
+      if self.transcript_cache and captions:
+         self.transcript_cache.put(video_id, language, captions)
+      return language, captions
+
+   def video_id(self, text: str) -> str:
+      """Id of the first YouTube video linked in the text"""
       url = get_youtube_url(text)
       if not url:
          raise NotYoutubeUrlException(f"Url {url} is not a YouTube url")
@@ -160,53 +345,169 @@ class Summarizer:
       video_id = get_youtube_video_id(url)
       if not video_id:
          raise NotYoutubeUrlException(f"Url {url} is not a YouTube url as it doesn't contain video ID")
+      return video_id
+
+   async def get_youtube_summary(self, chat_id: int, text: str, clarify: str=None, on_progress: Progress=None, check_seen: bool=True) -> str:
+      """
+      Extract captions from a YouTube video for [ru,en] or autogenerated [a.ru,a.en]
+      Strip the timestamps
+      Pass to a model backend
+      Stream partial output to on_progress when given
+      Refuse videos already seen in the chat and remember this one unless check_seen is off
+      """
+      logger.debug(text)
+
+      video_id = self.video_id(text)
+      url = get_youtube_url(text)
       
-      transcript_list = YouTubeTranscriptApi.list_transcripts(video_id, proxies=self.youtube_api_proxies)
-      transcript = transcript_list.find_transcript(['ru', 'en'])
-      
-      if chat_id in self.seen and not clarify:
-         if video_id in self.seen[chat_id]:
-            raise AlreadySeenException(f"Already seen it previously")
+      # Refuse duplicates before any YouTube or LLM I/O
+      if check_seen and not clarify and self.seen.contains(chat_id, video_id):
+         raise AlreadySeenException(f"Already seen it previously")
       
+      # Requests for the same video and question running at the same time share one result
+      with stage('summary_total'):
+         reply = await self.inflight.do((video_id, clarify), lambda progress: self.summarize_video(video_id, url, clarify, chat_id, progress), on_progress)
+      if check_seen and not clarify:
+         self.seen.add(chat_id, video_id)
+      return reply
+
+   async def load_transcript(self, video_id: str) -> Prefetched:
+      """
+      Fetch captions and tokenize them the way summarize_video does
+      Stop at the transcript cache when prefetch_tokenize is off
+      """
+      language, captions = await asyncio.to_thread(self.fetch_captions, video_id)
+      if not captions or not self.prefetch_tokenize:
+         return None
+      document = await asyncio.to_thread(self.build_document, captions, language)
+      return language, captions, document
+
+   def prefetch(self, chat_id: int, text: str) -> bool:
+      """
+      Start loading the transcript of a YouTube link in text in the background
+      Return False when prefetching is off or there is nothing to load
+      """
+      if not self.prefetcher:
+         return False
+      url = get_youtube_url(text)
+      video_id = get_youtube_video_id(url) if url else None
+      # A video seen in the chat is going to be refused anyway
+      if not video_id or self.seen.contains(chat_id, video_id):
+         return False
+      return self.prefetcher.schedule(video_id)
+
+   def build_document(self, captions: List[dict], language: str) -> TokenizedDocument:
+      """
+      Turn captions into a tokenized document, whole cues or cue groups are the chunking unit
+      Compact the transcript when enabled and log roughly how many tokens it saved
+      """
+      with stage('tokenize'):
+         srt_cues, srt_pauses = captions_to_srt_cues(captions)
+         if not self.compact_transcript:
+            document = TokenizedDocument(None, self.tokenizer, segments=srt_cues, pauses=srt_pauses)
+            TOKENS.labels('transcript').inc(document.token_count)
+            return document
+
+         segments, pauses = compact_captions(captions, language)
+         document = TokenizedDocument(None, self.tokenizer, segments=segments, pauses=pauses)
+      # Tokenizing the SRT form only to measure it would double the work, scale by characters instead
+      compact_chars = sum(len(segment) for segment in segments)
+      srt_tokens = sum(len(cue) for cue in srt_cues) * document.token_count // max(compact_chars, 1)
+      saved = srt_tokens - document.token_count
+      logger.info(f"Compaction saved {saved} of {srt_tokens} tokens ({saved * 100 // max(srt_tokens, 1)}%)")
+      TOKENS.labels('transcript').inc(document.token_count)
+      TOKENS.labels('saved_by_compaction').inc(max(saved, 0))
+      return document
+
+   def prompts(self, language: str, clarify: str=None) -> Tuple[str, str, str]:
+      """Prompt, final prompt and question for a transcript in the language"""
+      question = None
+      transcript_format = TRANSCRIPT_FORMAT[language]['compact' if self.compact_transcript else 'srt']
+      if language == 'ru':
+         if not clarify:
+            prompt = PROMPT_RU.format(format=transcript_format)
+            # final_prompt = FINAL_PROMPT_RU
+            final_prompt = None
+         else:
+            prompt = CLARIFY_PROMPT_RU.format(format=transcript_format)
+            question = CLARIFY_QUESTION_RU.format(clarify=clarify)
+            final_prompt = None
+      elif language == 'en':
+         if not clarify:
+            prompt = PROMPT_EN.format(format=transcript_format)
+            final_prompt = None
+         else:
+            prompt = CLARIFY_PROMPT_EN.format(format=transcript_format)
+            question = CLARIFY_QUESTION_EN.format(clarify=clarify)
+            final_prompt = None
+      return prompt, final_prompt, question
+
+   def summary_key(self, video_id: str, language: str, clarify: str=None) -> str:
+      prompt, final_prompt, question = self.prompts(language, clarify)
+      prompt_key = f"{prompt}\n{final_prompt}" + (f"\n{question}" if question else "")
+      return SummaryCache.make_key(video_id, language, prompt_key, self.chat_model)
+
+   async def summarize_video(self, video_id: str, url: str, clarify: str=None, chat_id: int=None, on_progress: Progress=None) -> str:
+      """
+      Serve a cached summary in any transcript language before touching YouTube
+      Otherwise fetch captions, pick the prompt for their language and summarize
+      """
+      if self.summary_cache:
+         for language in LANGUAGES:
+            cached = self.summary_cache.get(self.summary_key(video_id, language, clarify))
+            if cached:
+               cache_lookup('summary', True)
+               logger.info(f"Summary cache hit for {video_id} [{language}]")
+               return cached + CACHED_COST_LINE
+         cache_lookup('summary', False)
+
+      document = None
       try:
-         captions = None
-         if transcript.language_code == 'ru':
-            captions = YouTubeTranscriptApi.get_transcript(video_id, languages=['ru'], proxies=self.youtube_api_proxies)
-            captions_srt = SRTFormatter().format_transcript(captions)
-            if not clarify:
-               prompt = PROMPT_RU
-               # final_prompt = FINAL_PROMPT_RU
-               final_prompt = None
-            else:
-               prompt = f"Это транскрипция к видео в формате SRT. Проанализируй текст и перескажи что говорится про \"{clarify}\". Покажи временные метки где об этом говорится. Если об этом ничего нет напиши 'NOT_FOUND'"
-               final_prompt = None
-         elif transcript.language_code == 'en':
-            captions = YouTubeTranscriptApi.get_transcript(video_id, languages=['en'], proxies=self.youtube_api_proxies)
-            captions_srt = SRTFormatter().format_transcript(captions)
-            if not clarify:
-               prompt = PROMPT_EN
-               final_prompt = None
-            else:
-               prompt = f"This is transcript from video in SRT format. Show the timestamp where it says about {clarify}. If there is nothing about it in the video write 'NOT_FOUND'"
-               final_prompt = None
-         if not captions_srt:
+         prefetched = await self.prefetcher.get(video_id) if self.prefetcher else None
+         if prefetched:
+            language, captions, document = prefetched
+         else:
+            # The transcript API is blocking, keep it off the event loop
+            language, captions = await asyncio.to_thread(self.fetch_captions, video_id)
+         prompt, final_prompt, question = self.prompts(language, clarify)
+         if not captions:
             raise NoCaptionsException
-         
-         text = captions_srt
 
       except Exception as e:
          logger.error(e)
          raise NoCaptionsException(f"Cannot get captions for video{url}")
 
-      reply = self.summarize(text, prompt, final_prompt)
-      if not clarify:
-         self.seen[chat_id][video_id] = time.time()
-      return reply
+      cache_key = self.summary_key(video_id, language, clarify) if self.summary_cache else None
+
+      context = None
+      if clarify and self.clarify_top_k:
+         # Only the parts of the transcript relevant to the question go to the model
+         index = self.indexes.get((video_id, language))
+         cache_lookup('clarify_index', index is not None)
+         if index is None:
+            if document is None:
+               document = await asyncio.to_thread(self.build_document, captions, language)
+            index = await asyncio.to_thread(TranscriptIndex, document, self.clarify_window_tokens)
+            self.indexes[(video_id, language)] = index
+            while len(self.indexes) > INDEX_CACHE_SIZE:
+               self.indexes.popitem(last=False)
+         self.indexes.move_to_end((video_id, language))
+         context = index.search(clarify, self.clarify_top_k)
+
+      if context is None:
+         if document is None:
+            document = await asyncio.to_thread(self.build_document, captions, language)
+         if not document.segments:
+            raise NoCaptionsException(f"Nothing left in captions for video{url}")
+         context = document
+
+      reduce_prompt = REDUCE_PROMPT_RU if language == 'ru' else REDUCE_PROMPT_EN
+      return await self.summarize(context, prompt, final_prompt, cache_key=cache_key, reduce_prompt=reduce_prompt, chat_id=chat_id, on_progress=on_progress, question=question)
 
 
 if __name__ == '__main__':
    summarizer = Summarizer()
-   reply = summarizer.get_youtube_summary("https://youtu.be/DsUxuz_Rt8g")
+   reply = asyncio.run(summarizer.get_youtube_summary(None, "https://youtu.be/DsUxuz_Rt8g"))
    logger.info(reply)
 
 
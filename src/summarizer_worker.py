@@ -0,0 +1,105 @@
+"""
+Summarizer worker processes for the job queue.
+
+The bot only queues /short and /clarify requests when job_queue_path is set in
+config.yml, these processes claim them, summarize and store the result that
+the bot then sends. Run as many of them as the CPU and the LLM rate limits
+allow, on any host that sees the queue file.
+
+    python src/summarizer_worker.py --config config.yml --processes 4
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+
+import yaml
+
+from builders import build_job_queue, build_scheduler, build_summarizer, setup_logger
+from job_queue import ERROR_KINDS, Job, JobQueue
+from summarizer import Summarizer
+
+logger = logging.getLogger('bot.worker')
+
+# Errors that are an answer to the user, retrying them gives the same result
+FINAL_ERRORS = tuple(ERROR_KINDS.values())
+
+
+async def run_job(job: Job, job_queue: JobQueue, summarizer: Summarizer) -> None:
+    async def keep_claimed() -> None:
+        while True:
+            await asyncio.sleep(job_queue.visibility_timeout / 3)
+            try:
+                await asyncio.to_thread(job_queue.extend, job.id)
+            except Exception as e:
+                logger.warning(f"Cannot extend job {job.id}: {e}")
+
+    keeper = asyncio.create_task(keep_claimed())
+    payload = job.payload
+    try:
+        # The bot refuses seen videos before queueing and marks them on delivery
+        reply = await summarizer.get_youtube_summary(chat_id=payload["chat_id"], text=payload["text"], clarify=payload["clarify"], check_seen=False)
+        await asyncio.to_thread(job_queue.complete, job.id, result=reply)
+        logger.info(f"Job {job.id} is done")
+    except FINAL_ERRORS as e:
+        await asyncio.to_thread(job_queue.complete, job.id, error=e)
+    except Exception as e:
+        logger.warning(f"Job {job.id} failed on attempt {job.attempts}: {e}")
+        await asyncio.to_thread(job_queue.retry, job, e)
+    finally:
+        keeper.cancel()
+
+
+async def work(config: dict) -> None:
+    """Claim jobs while fewer than worker_concurrency of them are running in this process"""
+    job_queue = build_job_queue(config)
+    scheduler = build_scheduler(config)
+    summarizer = build_summarizer(config, scheduler)
+    poll_interval = config.get('worker_poll_interval', 1.0)
+    slots = asyncio.Semaphore(config.get('worker_concurrency', 2))
+    logger.info(f"Worker {os.getpid()} is ready")
+
+    async def run(job: Job) -> None:
+        try:
+            await run_job(job, job_queue, summarizer)
+        finally:
+            slots.release()
+
+    while True:
+        await slots.acquire()
+        job = await asyncio.to_thread(job_queue.claim)
+        if job is None:
+            slots.release()
+            await asyncio.sleep(poll_interval)
+            continue
+        asyncio.create_task(run(job))
+
+def run_worker(config: dict) -> None:
+    setup_logger(config.get('log_level', 'INFO').upper(), config.get('logfile', None))
+    asyncio.run(work(config))
+
+
+def main() -> None:
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', required=True, type=str, default=None, help="Path to config.yaml file.")
+    parser.add_argument('--processes', type=int, default=1, help="Worker processes to start.")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as file:
+        config = yaml.safe_load(file)
+    if not config.get('job_queue_path', None):
+        raise SystemExit("job_queue_path is not set in the config")
+
+    if args.processes == 1:
+        run_worker(config)
+        return
+    processes = [multiprocessing.Process(target=run_worker, args=(config,), daemon=True) for _ in range(args.processes)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
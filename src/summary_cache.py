@@ -0,0 +1,67 @@
+from collections import OrderedDict
+import hashlib
+import logging
+import time
+from typing import Optional
+
+from sqlite_writer import connect, WriteBehind
+
+logger = logging.getLogger('bot.summary_cache')
+
+
+class SummaryCache:
+    """Bounded in-memory LRU of generated summaries shared by all chats, optionally backed by SQLite"""
+    def __init__(self, max_entries: int=500, path: str=None, max_persisted: int=10000) -> None:
+        """Construct a :class:`SummaryCache <SummaryCache>`.
+
+        :param max_entries:
+            How many summaries are kept in memory
+        :param path:
+            (Optional) SQLite file to persist summaries across restarts
+        :param max_persisted:
+            How many summaries are kept in the SQLite file
+        """
+        self.max_entries = max_entries
+        self.max_persisted = max_persisted
+        self.entries = OrderedDict()
+        self.db = None
+        self.writer = None
+        if path:
+            self.db = connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, summary TEXT NOT NULL, accessed REAL NOT NULL)")
+            self.db.commit()
+            # Reads stay on this connection, writes are committed off the event loop
+            self.writer = WriteBehind(path)
+
+    @staticmethod
+    def make_key(video_id: str, language: str, prompt: str, chat_model: str) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]
+        return f"{video_id}:{language}:{prompt_hash}:{chat_model}"
+
+    def _remember(self, key: str, summary: str) -> None:
+        self.entries[key] = summary
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached summary or None"""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if not self.db:
+            return None
+        row = self.db.execute("SELECT summary FROM summaries WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        self.writer.execute("UPDATE summaries SET accessed = ? WHERE key = ?", (time.time(), key))
+        self._remember(key, row[0])
+        return row[0]
+
+    def put(self, key: str, summary: str) -> None:
+        """Store a summary, evicting least recently used ones over the limits"""
+        self._remember(key, summary)
+        if not self.db:
+            return
+        self.writer.execute("INSERT OR REPLACE INTO summaries (key, summary, accessed) VALUES (?, ?, ?)", (key, summary, time.time()))
+        self.writer.execute("DELETE FROM summaries WHERE key NOT IN (SELECT key FROM summaries ORDER BY accessed DESC LIMIT ?)", (self.max_persisted,))
@@ -1,14 +1,20 @@
-from datetime import datetime
+import asyncio
 from functools import wraps
 import logging
 import os
 import re
 import traceback
-from typing import Optional
+from typing import Optional, Set
 
 import yaml
+from builders import build_job_queue, build_scheduler, build_summarizer, setup_logger
 from chat import Chat
-from summarizer import Summarizer
+from conversation_store import ConversationStore
+from job_queue import Job, JobQueue
+from metrics import count_error, HANDLER_SECONDS, READY, start_metrics_server
+from outbound import OutboundSender
+from streaming import StreamingReply
+from update_processor import ChatUpdateProcessor
 from exceptions import *
 from telegram import Update
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackContext, ConversationHandler, MessageHandler, filters
@@ -21,26 +27,17 @@ logger = logging.getLogger('bot')
 HELP_USAGE = "Натрави меня реплаем на сообщение, в котором есть ссылка на YouTube видео и напиши /short@imikdev_bot"
 HELP_USAGE_CLARIFY = "Натрави меня реплаем на сообщение, в котором есть ссылка на YouTube видео. Напиши в одном реплае /clarify@imikdev_bot и добавь что нужно уточнить."
 
+# Set when summaries are handed to worker processes
+job_queue: Optional[JobQueue] = None
+QUEUED_REPLY = "Поставил в очередь, пришлю саммари, когда будет готово."
+ALREADY_QUEUED_REPLY = "Это видео уже в очереди, пришлю саммари, когда будет готово."
+EMPTY_REPLY = "Модель ничего не ответила."
+
 class AlwaysInWhitelist:
     def __eq__(self, _):
         return True
 
 
-def setup_logger(log_level: Optional[str]='INFO', logfile: Optional[str]=None) -> None:
-    """Logger setup to write into console and to the file (Optional)"""
-    log_formatter = logging.Formatter('%(asctime)s %(name)s [%(levelname)s] %(message)s', datefmt='%d-%m-%Y %H:%M:%S')
-    logger.setLevel(log_level)
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(log_level)
-    console_handler.setFormatter(log_formatter)
-    logger.addHandler(console_handler)
-
-    if logfile:
-        fileHandler = logging.FileHandler("{0}_{1}".format(logfile, datetime.utcnow().strftime('%F_%T.%f')[:-3]))
-        fileHandler.setLevel(log_level)
-        fileHandler.setFormatter(log_formatter)
-        logger.addHandler(fileHandler)
-
 def auth(func):
     """Decorator to restrict access to whitelisted users."""
     @wraps(func)
@@ -56,52 +53,143 @@ def auth(func):
         return await func(update, context, *args, **kwargs)
     return wrapper
 
+def instrumented(func):
+    """Decorator to measure how long a handler takes."""
+    @wraps(func)
+    async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+        with HANDLER_SECONDS.labels(func.__name__).time():
+            return await func(update, context, *args, **kwargs)
+    return wrapper
+
+
+def start_streaming(update: Update, context: CallbackContext) -> Optional[StreamingReply]:
+    """Reply that is edited while the model generates, None when streaming is off"""
+    if not stream_replies:
+        return None
+    chat_id = update.message.chat_id
+    # Groups allow about 20 edits a minute, the same pace the sender keeps there
+    min_interval = stream_edit_interval if chat_id > 0 else max(stream_edit_interval, sender.group_interval)
+    return StreamingReply(sender, chat_id, update.message.message_id, min_interval=min_interval)
+
+
+def summary_error_reply(e: Exception, message: str) -> str:
+    """Text the user gets when the summary of message failed"""
+    count_error(e)
+    if isinstance(e, AlreadySeenException):
+        logger.debug(f"Seen this url before {message}")
+        return f"Была уже эта ссылка. Не ленись поскролить выше."
+    if isinstance(e, NotYoutubeUrlException):
+        logger.debug("".join(traceback.format_exception(e)))
+        logger.debug(f"Cannot find a YouTube url {message}")
+        return f"Ссылки на YouTube видео нету."
+    if isinstance(e, NoCaptionsException):
+        logger.debug(f"Canot get captions for {message}")
+        return f"Не смог получить субтитры для видео."
+    if isinstance(e, TooExpensiveException):
+        logger.debug(f"Too expensive {e}")
+        return f"Братишка, чет дорого выходит {e}."
+    logger.warning("".join(traceback.format_exception(e)))
+    logger.warning(e)
+    logger.warning(f"Failed to reply with a summary to {message}")
+    return f"Что-то пошло не так {message}. Ошибка: {e}"
+
+
+async def deliver_job(job: Job, delivering: Set[int], poll_interval: float) -> None:
+    """Send the outcome of a job and forget the job, retrying the acknowledgement until it is stored"""
+    payload = job.payload
+    try:
+        reply = job.result
+        error = job.exception()
+        if error:
+            reply = summary_error_reply(error, payload["text"])
+        elif not payload["clarify"]:
+            summarizer.seen.add(payload["chat_id"], payload["video_id"])
+        await sender.send(payload["chat_id"], reply, reply_to_message_id=payload["message_id"])
+    except Exception as e:
+        count_error(e)
+        logger.warning(f"Cannot deliver job {job.id} to {payload['chat_id']}: {e}")
+    try:
+        while True:
+            try:
+                await asyncio.to_thread(job_queue.acknowledge, job.id)
+                break
+            except Exception as e:
+                logger.warning(f"Cannot acknowledge job {job.id}, retrying: {e}")
+                await asyncio.sleep(poll_interval)
+    finally:
+        delivering.discard(job.id)
+
+
+async def deliver_results(poll_interval: float=1.0) -> None:
+    """Send the summaries finished by the worker processes, each job on its own so a slow chat holds up no other"""
+    delivering: Set[int] = set()
+    while True:
+        try:
+            jobs = await asyncio.to_thread(job_queue.finished, len(delivering) + 50)
+        except Exception as e:
+            logger.warning(f"Cannot read finished jobs: {e}")
+            jobs = []
+        jobs = [job for job in jobs if job.id not in delivering]
+        for job in jobs:
+            delivering.add(job.id)
+            asyncio.create_task(deliver_job(job, delivering, poll_interval))
+        if not jobs:
+            await asyncio.sleep(poll_interval)
+
+async def queue_summary(update: Update, message: str, clarify: Optional[str]) -> str:
+    """Hand the request to the worker processes and return the acknowledgement for the user"""
+    chat_id = update.message.chat_id
+    video_id = summarizer.video_id(message)
+    # Workers have registries of their own, so seen videos are refused here and marked on delivery
+    if not clarify and summarizer.seen.contains(chat_id, video_id):
+        raise AlreadySeenException(f"Already seen it previously")
+    job_id = await asyncio.to_thread(job_queue.put, 'summary', {
+        "chat_id": chat_id,
+        "message_id": update.message.message_id,
+        "text": message,
+        "video_id": video_id,
+        "clarify": clarify,
+    }, dedupe_key=f"{chat_id}:{video_id}:{clarify}")
+    if job_id is None:
+        logger.info(f"{video_id} is already queued for {chat_id}")
+        return ALREADY_QUEUED_REPLY
+    logger.info(f"Queued job {job_id}, {await asyncio.to_thread(job_queue.depth)} jobs in the queue")
+    return QUEUED_REPLY
+
 
 async def process_request(update: Update, context: CallbackContext, clarify=None) -> None:
+    streaming = None
     if update.message.reply_to_message:
         message = update.message.reply_to_message.text
         logger.info(f'From {update.message.chat_id}: {update.message.from_user.name} received {message}')
         try:
             if clarify:
                 clarify = re.sub(r"/clarify|@imikdev_bot", "", update.message.text)
-            reply = summarizer.get_youtube_summary(chat_id=update.message.chat_id, text=message, clarify=clarify)
-        except AlreadySeenException:
-            logger.debug(f"Seen this url before {message}")
-            reply = f"Была уже эта ссылка. Не ленись поскролить выше."
-        except NotYoutubeUrlException:
-            logger.debug(traceback.format_exc())                        
-            logger.debug(f"Cannot find a YouTube url {message}")
-            reply = f"Ссылки на YouTube видео нету."
-            pass
-        except NoCaptionsException:
-            logger.debug(f"Canot get captions for {message}")
-            reply = f"Не смог получить субтитры для видео."
-        except TooExpensiveException as e:
-            logger.debug(f"Too expensive {e}")
-            reply = f"Братишка, чет дорого выходит {e}."
+            if job_queue:
+                # A worker process summarizes it, deliver_results sends the reply
+                acknowledgement = await queue_summary(update, message, clarify)
+                await sender.send(update.message.chat_id, acknowledgement, reply_to_message_id=update.message.message_id)
+                return
+            streaming = start_streaming(update, context)
+            if streaming:
+                await streaming.start()
+            reply = await summarizer.get_youtube_summary(
+                chat_id=update.message.chat_id,
+                text=message,
+                clarify=clarify,
+                on_progress=streaming.update if streaming else None
+            )
         except Exception as e:
-            logger.warning(traceback.format_exc())                        
-            logger.warning(e)      
-            logger.warning(f"Failed to reply with a summary to {message}")
-            reply = f"Что-то пошло не так {message}. Ошибка: {e}"
-            pass
+            reply = summary_error_reply(e, message)
     else:
         reply = HELP_USAGE_CLARIFY if clarify else HELP_USAGE
 
-    chunk_size = 3500
-    chunks = [
-        reply[i : i + chunk_size]
-        for i in range(0, len(reply), chunk_size)
-    ]
-
-    for chunk in chunks:
-        await context.bot.send_message(
-            update.message.chat_id,
-            reply_to_message_id=update.message.message_id,
-            text=chunk,
-            # To preserve the markdown, we attach entities (bold, italic...)
-            entities=update.message.entities
-        )
+    if streaming:
+        await streaming.finish(reply)
+        return
+
+    # To preserve the markdown, we attach entities (bold, italic...)
+    await sender.send(update.message.chat_id, reply, reply_to_message_id=update.message.message_id, entities=update.message.entities)
 
 async def process_system_prompt(update: Update, context: CallbackContext) -> None:
     message = update.message.text
@@ -111,14 +199,11 @@ async def process_system_prompt(update: Update, context: CallbackContext) -> Non
     user_id = update.message.from_user.id
     free_chat.set_system_prompt(chat_id, user_id, message)
 
-    await context.bot.send_message(
-        chat_id,
-        reply_to_message_id=update.message.message_id,
-        text=f"Системный промпт установлен на {message}"
-    )
+    await sender.send(chat_id, f"Системный промпт установлен на {message}", reply_to_message_id=update.message.message_id)
 
 
 async def process_free_chat(update: Update, context: CallbackContext) -> None:
+    streaming = None
     try:
         message = update.message.text
         if context.bot.username in message:
@@ -130,34 +215,41 @@ async def process_free_chat(update: Update, context: CallbackContext) -> None:
         user_id = update.message.from_user.id
         id = update.message.message_id
         reply_id = update.message.reply_to_message.message_id if update.message.reply_to_message else None
-        reply = free_chat.free_chat(message, chat_id=chat_id, user_id=user_id, message_id=id, reply_id=reply_id)
+        streaming = start_streaming(update, context)
+        if streaming:
+            await streaming.start()
+        reply = await free_chat.free_chat(
+            message,
+            chat_id=chat_id,
+            user_id=user_id,
+            message_id=id,
+            reply_id=reply_id,
+            on_progress=streaming.update if streaming else None
+        )
         content = reply["content"]
     except TooLongMessageException as e:
+        count_error(e)
         logger.debug(f"Too long {e}")
-        reply = f"Наш разговор получился слишком длинным. Давай начнем с чистого листа. {e}."
+        content = f"Наш разговор получился слишком длинным. Давай начнем с чистого листа. {e}."
+        reply = {"role": "assistant", "content": content}
     except Exception as e:
+        count_error(e)
         logger.warning(traceback.format_exc())                        
         logger.warning(e)      
         logger.warning(f"Failed to reply with a summary to {message}")
-        reply = f"Что-то пошло не так {message}. Ошибка: {e}"
-        pass
-
-    chunk_size = 3500
-    chunks = [
-        content[i : i + chunk_size]
-        for i in range(0, len(reply), chunk_size)
-    ]
-
-    for chunk in chunks:
-        sent_message = await context.bot.send_message(
-            update.message.chat_id,
-            reply_to_message_id=update.message.message_id,
-            text=chunk,
-            # To preserve the markdown, we attach entities (bold, italic...)
-            # entities=update.message.entities
-        )
-    free_chat.conversation[chat_id][sent_message.message_id] = {"request": reply, "reply_id": update.message.message_id}
+        content = f"Что-то пошло не так {message}. Ошибка: {e}"
+        reply = {"role": "assistant", "content": content}
+
+    if not content.strip():
+        # Telegram refuses empty messages, the sender would have nothing to send
+        content = EMPTY_REPLY
+    if streaming:
+        sent_messages = await streaming.finish(content)
+    else:
+        sent_messages = await sender.send(update.message.chat_id, content, reply_to_message_id=update.message.message_id)
+    free_chat.add_message(update.message.chat_id, sent_messages[-1].message_id, reply, update.message.message_id)
 
+@instrumented
 @auth
 async def clarify(update: Update, context: CallbackContext) -> None:
     """This handler will exctract YouTube link from the replayed message and will apply custom prompt to it"""
@@ -166,6 +258,7 @@ async def clarify(update: Update, context: CallbackContext) -> None:
     logger.info(f'From {update.message.chat_id}: {update.message.from_user.name} wrote {update.message.text}')
     await process_request(update=update, context=context, clarify=True)
 
+@instrumented
 @auth
 async def short(update: Update, context: CallbackContext) -> None:
     """This handler will exctract YouTube link from the replayed message and will apply summarize it"""
@@ -174,6 +267,7 @@ async def short(update: Update, context: CallbackContext) -> None:
     logger.info(f'From {update.message.chat_id}: {update.message.from_user.name} wrote {update.message.text}')
     await process_request(update=update, context=context)
 
+@instrumented
 @auth
 async def system(update: Update, context: CallbackContext) -> None:
     """This handler will use the message to set a system prompt"""
@@ -181,6 +275,7 @@ async def system(update: Update, context: CallbackContext) -> None:
     logger.info(f'From {update.message.chat_id}: {update.message.from_user.name} wrote {update.message.text}')
     await process_system_prompt(update=update, context=context)
 
+@instrumented
 @auth
 async def prompt(update: Update, context: CallbackContext) -> None:
     """This handler will use the message as a general prompt"""
@@ -188,12 +283,47 @@ async def prompt(update: Update, context: CallbackContext) -> None:
     logger.info(f'From {update.message.chat_id}: {update.message.from_user.name} wrote {update.message.text}')
     await process_free_chat(update=update, context=context)
 
+@instrumented
 @auth
 async def handle_direct_message(update: Update, context: CallbackContext) -> None:
     """Process messages sent directly to the bot or mentioned in a group."""
     logger.info(f'From {update.message.chat_id}: {update.message.from_user.name} wrote {update.message.text}')
     await process_free_chat(update=update, context=context)
 
+async def prefetch_transcript(update: Update, context: CallbackContext) -> None:
+    """Start loading the transcript of a YouTube link posted in a whitelisted chat, so a later /short starts at the LLM"""
+    message = update.message
+    if message.from_user.id not in id_whitelist and message.chat_id not in id_whitelist:
+        return
+    if summarizer.prefetch(message.chat_id, message.text):
+        logger.info(f"Prefetching a transcript for {message.chat_id}")
+
+async def on_ready(application) -> None:
+    """Mark the bot ready for the /healthz probe and start delivering queued summaries"""
+    if job_queue:
+        application.create_task(deliver_results())
+    READY.set()
+
+def run_webhook(application, config: dict) -> None:
+    """Receive updates on the webhook server of python-telegram-bot instead of long polling"""
+    url = config.get('webhook_url', None)
+    if not url:
+        raise SystemExit("webhook_url is not set in the config, Telegram needs it to reach the webhook")
+    secret = config.get('webhook_secret', None) or os.environ.get('TELEGRAM_WEBHOOK_SECRET', None)
+    if not secret:
+        # Every instance behind a balancer registers the webhook, they must all expect the same secret
+        raise SystemExit("webhook_secret is not set in the config nor in TELEGRAM_WEBHOOK_SECRET")
+    application.run_webhook(
+        # Only a local reverse proxy reaches it unless configured otherwise
+        listen=config.get('webhook_host', '127.0.0.1'),
+        port=config.get('webhook_port', 8443),
+        url_path=config.get('webhook_path', 'telegram'),
+        secret_token=secret,
+        webhook_url=url,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=config.get('webhook_max_connections', 40),
+    )
+
 def main() -> None:
     import argparse
     parser = argparse.ArgumentParser(description=__doc__)
@@ -215,22 +345,56 @@ def main() -> None:
     
     base_url = config.get('base_url', "https://api.deepseek.com")
 
-    proxies = config.get('youtube_api_proxies', None)
-    if not proxies:
-        proxies = {}
-        if os.environ.get('HTTP_PROXY', None):
-            proxies['http'] = os.environ['HTTP_PROXY']
-        if os.environ.get('HTTPS_PROXY', None):
-            proxies['https'] = os.environ['HTTPS_PROXY']
+    scheduler = build_scheduler(config)
+
+    global stream_replies, stream_edit_interval
+    stream_replies = config.get('stream_replies', True)
+    stream_edit_interval = config.get('stream_edit_interval', 2.0)
 
     global summarizer
-    summarizer = Summarizer(base_url=base_url, youtube_api_proxies=proxies)
-    
+    summarizer = build_summarizer(config, scheduler)
+
+    global job_queue
+    if config.get('job_queue_path', None):
+        job_queue = build_job_queue(config)
+
     global free_chat
-    free_chat = Chat(base_url=base_url)
+    conversations = ConversationStore(
+        max_nodes=config.get('conversation_max_nodes', 100000),
+        max_nodes_per_chat=config.get('conversation_max_nodes_per_chat', 5000),
+        ttl=config.get('conversation_ttl', 7 * 24 * 3600),
+        path=config.get('conversation_path', None),
+    )
+    free_chat = Chat(
+        base_url=base_url,
+        scheduler=scheduler,
+        store=conversations,
+        compact_at=config.get('chat_compact_at', 40000),
+        keep_recent_tokens=config.get('chat_keep_recent_tokens', 8000),
+    )
+
+    metrics_port = config.get('metrics_port', 9100)
+    if metrics_port:
+        start_metrics_server(config.get('metrics_host', '127.0.0.1'), metrics_port)
 
     api_token = os.environ.get('TELEGRAM_API_TOKEN', None)
-    application = ApplicationBuilder().token(api_token).build()
+    # Chats are served concurrently, summaries and free chat in separate lanes, each keeping the order of a chat
+    update_processor = ChatUpdateProcessor(
+        max_concurrent_updates=config.get('max_concurrent_updates', 16),
+        heavy_workers=config.get('heavy_workers', 4),
+        light_workers=config.get('light_workers', 12),
+        max_pending_updates=config.get('max_pending_updates', 1024),
+    )
+    webhook = config.get('mode', 'polling') == 'webhook'
+    application = ApplicationBuilder().token(api_token).concurrent_updates(update_processor).post_init(on_ready).build()
+
+    global sender
+    sender = OutboundSender(
+        application.bot,
+        messages_per_second=config.get('telegram_messages_per_second', 30),
+        private_interval=config.get('telegram_private_interval', 1.0),
+        group_interval=config.get('telegram_group_interval', 3.0),
+    )
 
     # Initialize the bot asynchronously
     bot_username = "imikdev_bot"
@@ -244,8 +408,15 @@ def main() -> None:
     # Register direct message handler
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_direct_message))
 
+    if summarizer.prefetcher:
+        # A group of its own so it sees every message, it only schedules a background task
+        application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r"https?://\S*youtu"), prefetch_transcript), group=-1)
+
     # Start the Bot
-    application.run_polling()
+    if webhook:
+        run_webhook(application, config)
+    else:
+        application.run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+from itertools import accumulate
+import logging
+from typing import List, Tuple
+
+logger = logging.getLogger('bot.tokenized_document')
+
+# Above this many characters the text is encoded in parallel threads
+BATCH_THRESHOLD = 200000
+BATCH_THREADS = 4
+# Pause alignment only looks for a cut once a chunk is this full
+PAUSE_MIN_FILL = 0.75
+
+
+class TokenizedDocument:
+    """Text encoded once, segment by segment, and shared by cost estimation and chunking"""
+    def __init__(self, text: str, tokenizer, batch_threshold: int=BATCH_THRESHOLD, num_threads: int=BATCH_THREADS, segments: List[str]=None, pauses: List[float]=None) -> None:
+        """Construct a :class:`TokenizedDocument <TokenizedDocument>`.
+
+        :param text:
+            Text to encode, ignored when segments are given
+        :param tokenizer:
+            tiktoken encoding to use
+        :param batch_threshold:
+            Text length in characters after which encoding is spread across threads
+        :param num_threads:
+            Number of threads for the batch encoding
+        :param segments:
+            (Optional) Units that are never split between chunks, lines of the text by default
+        :param pauses:
+            (Optional) Silence in seconds before each segment, used to cut chunks at natural pauses
+        """
+        self.segments = segments if segments is not None else text.splitlines(keepends=True)
+        self.text = "".join(self.segments) if segments is not None else text
+        self.pauses = pauses
+        self.tokenizer = tokenizer
+        threads = num_threads if len(self.text) > batch_threshold else 1
+        self.tokens = tokenizer.encode_batch(self.segments, num_threads=threads) if self.segments else []
+        self.counts = [len(tokens) for tokens in self.tokens]
+        self.token_count = sum(self.counts)
+        self.offsets = [0] + list(accumulate(len(segment) for segment in self.segments))
+        self.bounds = {}
+        logger.debug(f"Encoded {len(self.segments)} segments into {self.token_count} tokens with {threads} threads")
+
+    def chunk_bounds(self, chunk_size: int, overlap: int=0, align_to_pauses: bool=False) -> List[Tuple[int, int]]:
+        """
+        Pack whole segments into chunks of at most chunk_size tokens
+        Once a chunk is mostly full prefer to end it before the longest pause
+        Start every next chunk with the last overlap segments of the previous one
+        Return (first segment, last segment + 1) pairs, a single longer segment makes its own chunk
+        """
+        key = (chunk_size, overlap, align_to_pauses)
+        if key in self.bounds:
+            return self.bounds[key]
+        use_pauses = align_to_pauses and self.pauses is not None
+        n = len(self.counts)
+        bounds = []
+        start = 0
+        while start < n:
+            end, size = start, 0
+            cut, longest_pause = None, -1.0
+            while end < n and (end == start or size + self.counts[end] <= chunk_size):
+                size += self.counts[end]
+                end += 1
+                if use_pauses and end < n and size >= chunk_size * PAUSE_MIN_FILL and self.pauses[end] > longest_pause:
+                    cut, longest_pause = end, self.pauses[end]
+            if end < n and cut is not None:
+                end = cut
+            bounds.append((start, end))
+            if end >= n:
+                break
+            start = max(end - overlap, start + 1)
+        self.bounds[key] = bounds
+        return bounds
+
+    def chunks(self, chunk_size: int, overlap: int=0, align_to_pauses: bool=False) -> List[str]:
+        """Slice the original text along chunk bounds without decoding tokens back"""
+        chunks = []
+        for start, end in self.chunk_bounds(chunk_size, overlap, align_to_pauses):
+            if end - start == 1 and self.counts[start] > chunk_size:
+                # A single segment above the budget is the only case that has to be cut by tokens
+                tokens = self.tokens[start]
+                chunks.extend(self.tokenizer.decode(tokens[i : i + chunk_size]) for i in range(0, len(tokens), chunk_size))
+            else:
+                chunks.append(self.text[self.offsets[start] : self.offsets[end]])
+        return chunks
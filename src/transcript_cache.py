@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from typing import List, Optional
+
+logger = logging.getLogger('bot.transcript_cache')
+
+
+class TranscriptCache:
+    """
+    Compressed on-disk transcript cache with a byte budget, LRU eviction and TTL
+    Processes sharing the directory see each other's files, the budget is kept over the whole directory
+    """
+    def __init__(self, path: str, max_bytes: int=256 * 1024 * 1024, ttl: int=7 * 24 * 3600) -> None:
+        """Construct a :class:`TranscriptCache <TranscriptCache>`.
+
+        :param path:
+            Directory to keep the cache files in, it survives restarts
+        :param max_bytes:
+            Total size of the compressed files after which least recently used ones are evicted
+        :param ttl:
+            Seconds after which a cached transcript is considered stale
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load_index()
+        logger.info(f"Loaded {len(self.entries)} transcripts, {self.size} bytes")
+
+    def _load_index(self) -> None:
+        """Restore LRU order from file modification times, which are bumped on every hit"""
+        self.entries = OrderedDict()
+        self.size = 0
+        files = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json.gz'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                # Evicted by another process meanwhile
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+
+    def _file_name(self, video_id: str, language: str) -> str:
+        return f"{video_id}.{language}.json.gz"
+
+    def _remove(self, name: str) -> None:
+        self.size -= self.entries.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+    def get(self, video_id: str, language: str) -> Optional[List[dict]]:
+        """Return cached captions or None if missing or expired"""
+        name = self._file_name(video_id, language)
+        with self.lock:
+            file_path = os.path.join(self.path, name)
+            if name not in self.entries:
+                # Another process may have written it since the index was built
+                try:
+                    self.entries[name] = os.stat(file_path).st_size
+                except FileNotFoundError:
+                    return None
+                self.size += self.entries[name]
+            try:
+                with gzip.open(file_path, 'rt', encoding='utf-8') as f:
+                    payload = json.load(f)
+            except FileNotFoundError:
+                self.size -= self.entries.pop(name)
+                return None
+            except (OSError, ValueError) as e:
+                logger.warning(f"Dropping broken cache file {name}: {e}")
+                self._remove(name)
+                return None
+            if time.time() - payload['created'] > self.ttl:
+                self._remove(name)
+                return None
+            self.entries.move_to_end(name)
+            os.utime(file_path)
+            return payload['captions']
+
+    def put(self, video_id: str, language: str, captions: List[dict]) -> None:
+        """Store captions and evict least recently used transcripts over the byte budget"""
+        name = self._file_name(video_id, language)
+        data = gzip.compress(json.dumps({'created': time.time(), 'captions': captions}, ensure_ascii=False).encode('utf-8'))
+        with self.lock:
+            if name in self.entries:
+                self._remove(name)
+            tmp_path = os.path.join(self.path, f".{name}.{os.getpid()}.tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.path, name))
+            # Other processes write to the directory too, so the budget is checked against all of it
+            self._load_index()
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                oldest = next(iter(self.entries))
+                logger.debug(f"Evicting {oldest} from transcript cache")
+                self._remove(oldest)
@@ -0,0 +1,47 @@
+from collections import deque
+import logging
+import time
+from typing import List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from youtube_transcript_api._transcripts import TranscriptListFetcher
+
+logger = logging.getLogger('bot.transcript_fetcher')
+
+
+class TranscriptFetcher:
+    """Fetch transcripts in one pass over a pooled keep-alive HTTP session"""
+    def __init__(self, proxies: dict[str, str]=None, pool_size: int=8, keep_timings: int=100) -> None:
+        """Construct a :class:`TranscriptFetcher <TranscriptFetcher>`.
+
+        :param proxies:
+            (Optional) A dict mapping protocol to proxy address
+        :param pool_size:
+            How many connections per host are kept alive
+        :param keep_timings:
+            How many recent fetch timings are kept in memory
+        """
+        self.session = requests.Session()
+        self.session.proxies = proxies or {}
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timings = deque(maxlen=keep_timings)
+
+    def fetch(self, video_id: str, languages: List[str]) -> Tuple[str, List[dict]]:
+        """
+        List the transcripts, pick the first available language and download it
+        The chosen transcript is fetched directly instead of being looked up again
+        """
+        started = time.perf_counter()
+        transcript_list = TranscriptListFetcher(self.session).fetch(video_id)
+        transcript = transcript_list.find_transcript(languages)
+        listed = time.perf_counter()
+        captions = transcript.fetch()
+        finished = time.perf_counter()
+
+        timing = {'video_id': video_id, 'list': listed - started, 'fetch': finished - listed, 'total': finished - started}
+        self.timings.append(timing)
+        logger.info(f"Fetched {video_id} [{transcript.language_code}] in {timing['total']:.2f}s (list {timing['list']:.2f}s, captions {timing['fetch']:.2f}s)")
+        return transcript.language_code, captions
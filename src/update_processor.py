@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import UPDATES_WAITING
+
+logger = logging.getLogger('bot.update_processor')
+
+# Commands that go to the heavy lane, everything else is light
+HEAVY_COMMANDS = {'/short', '/clarify'}
+HEAVY = 'heavy'
+LIGHT = 'light'
+
+
+def update_lane(update: object) -> str:
+    message = update.message if isinstance(update, Update) else None
+    if message and message.text:
+        words = message.text.split(maxsplit=1)
+        if words and words[0].split('@')[0] in HEAVY_COMMANDS:
+            return HEAVY
+    return LIGHT
+
+def update_chat(update: object):
+    if isinstance(update, Update) and update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Process updates of different chats concurrently, in heavy and light lanes
+    Updates of a chat keep their arrival order within a lane, a long summary does not hold up the chat's light updates
+    """
+    def __init__(self, max_concurrent_updates: int=16, heavy_workers: int=4, light_workers: int=12, max_pending_updates: int=1024) -> None:
+        """Construct a :class:`ChatUpdateProcessor <ChatUpdateProcessor>`.
+
+        :param max_concurrent_updates:
+            Updates processed at the same time over both lanes
+        :param heavy_workers:
+            Summarization updates processed at the same time
+        :param light_workers:
+            Free chat and other light updates processed at the same time
+        :param max_pending_updates:
+            Updates accepted before fetching more waits, including the ones waiting for their chat
+        """
+        super().__init__(max_pending_updates)
+        self.running = asyncio.Semaphore(max_concurrent_updates)
+        self.lanes = {HEAVY: asyncio.Semaphore(heavy_workers), LIGHT: asyncio.Semaphore(light_workers)}
+        # Lock and number of updates holding or waiting for it per chat and lane
+        self.chats: Dict[Any, list] = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        chat_id = update_chat(update)
+        lane = update_lane(update)
+        if chat_id is None:
+            await self.run(lane, coroutine)
+            return
+        # Lock waiters are woken in FIFO order, which keeps the updates of a chat lane in sequence
+        key = (chat_id, lane)
+        entry = self.chats.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self.run(lane, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.chats[key]
+
+    async def run(self, lane: str, coroutine: Awaitable[Any]) -> None:
+        waiting = UPDATES_WAITING.labels(lane)
+        waiting.inc()
+        started = False
+        try:
+            async with self.lanes[lane], self.running:
+                waiting.dec()
+                started = True
+                await coroutine
+        finally:
+            if not started:
+                waiting.dec()